@@ -1,11 +1,38 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
 import time
 import os
 import json
+import atexit
+import base64
+import bisect
+import math
+import mmap
+import queue
+import struct
+import threading
+import tempfile
+import fcntl
 from functools import lru_cache
 from datetime import datetime
 import gzip
+import hashlib
+import stat
+import hmac
+import zlib
+import csv
+import io
+import glob
+import uuid
+import cProfile
+import itertools
+import marshal
+import pstats
+from array import array
+from collections import OrderedDict
+from urllib.parse import urlencode
+import requests
+from postgrest.exceptions import APIError
 from supabase import create_client
 
 app = Flask(__name__)
@@ -15,6 +42,136 @@ CORS(app)
 TIMEOUT = 30
 CACHE_TTL = 1  # Cache for 1 second
 
+# Table name in Supabase
+TABLE_NAME = "users"
+
+def _private_dir(path):
+    """Create path as a directory only this user can enter, refusing one someone else set up."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(f"{path} must be a directory owned by this user with mode 0700")
+    return path
+
+# Files shared by this deployment's workers (snapshot, tombstones, metrics...)
+# live in a private directory named after the Supabase project and table, so
+# instances on one host that serve different projects never share state
+STATE_DIR = _private_dir(os.environ.get("STATE_DIR") or os.path.join(
+    tempfile.gettempdir(),
+    "diamond_monitor_{}_{}".format(
+        os.getuid(), hashlib.sha256(f'{os.environ.get("SUPABASE_URL", "")}|{TABLE_NAME}'.encode()).hexdigest()[:16]
+    )
+))
+
+# Write-behind buffer for /send_data (set WRITE_BEHIND=0 to upsert synchronously)
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "1") != "0"
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", 1.0))  # seconds between bulk upserts
+FLUSH_MAX_ROWS = int(os.environ.get("FLUSH_MAX_ROWS", 500))  # flush early once this many users are pending
+FLUSH_MAX_ATTEMPTS = int(os.environ.get("FLUSH_MAX_ATTEMPTS", 5))  # failed flushes before a buffered row is dropped
+
+# Heartbeats that change nothing only refresh an in-memory last-seen map; the
+# row is rewritten once its persisted timestamp is HEARTBEAT_REFRESH old
+HEARTBEAT_REFRESH = float(os.environ.get("HEARTBEAT_REFRESH", TIMEOUT / 3))  # seconds, keep well below TIMEOUT; 0 = write every heartbeat
+# A stored timestamp can lag the last heartbeat by HEARTBEAT_REFRESH, so only
+# rows older than this are certainly offline (what deletes must go by)
+OFFLINE_AFTER = TIMEOUT + HEARTBEAT_REFRESH
+SEEN_PATH = os.environ.get(
+    "SEEN_PATH", os.path.join(STATE_DIR, "seen")
+)
+SEEN_PUBLISH_INTERVAL = 1.0  # seconds between publishing this worker's last-seen map to the others
+
+# Limits for /send_batch
+MAX_BATCH_RECORDS = int(os.environ.get("MAX_BATCH_RECORDS", 5000))
+MAX_BATCH_BYTES = int(os.environ.get("MAX_BATCH_BYTES", 8 * 1024 * 1024))  # after gzip decoding
+
+# Delta sync for /get_data?since=<cursor>
+TOMBSTONE_RETENTION = int(os.environ.get("TOMBSTONE_RETENTION", 600))  # seconds a deletion stays visible to delta clients
+TOMBSTONE_PATH = os.environ.get(
+    "TOMBSTONE_PATH", os.path.join(STATE_DIR, "tombstones.jsonl")
+)
+# Rows are stamped when they are queued, not when they land in Supabase, and a
+# row that fails to flush is retried up to FLUSH_MAX_ATTEMPTS more intervals
+DELTA_OVERLAP_MS = int(((FLUSH_INTERVAL * (FLUSH_MAX_ATTEMPTS + 1) if WRITE_BEHIND else 0) + 2) * 1000)
+
+# Snapshots shared by all workers on this host, one per mode: "all" users, or
+# only "online" ones (/get_data?status=online, filtered by Supabase)
+SNAPSHOT_PATH = os.environ.get(
+    "SNAPSHOT_PATH", os.path.join(STATE_DIR, "snapshot")
+)
+SNAPSHOT_MODES = ("all", "online")
+SNAPSHOT_COLUMNS = "username,diamonds,diamonds_total,device,timestamp"  # what format_user reads
+
+# Compact /get_data encoding, negotiated with ?format=columnar or this Accept type
+COLUMNAR_MIMETYPE = "application/vnd.diamond-monitor.columnar+json"
+
+# Serve a stale snapshot this long (seconds) while one refresh runs in the background; 0 disables
+CACHE_MAX_STALENESS = float(os.environ.get("CACHE_MAX_STALENESS", 5.0))
+
+# Server-Sent Events push (/stream). An open stream holds a worker thread for as
+# long as the tab is open, so streams are only offered when WORKER_THREADS (set it
+# to gunicorn's --threads with -k gthread) leaves STREAM_RESERVED_THREADS free for
+# everything else; otherwise the dashboard polls
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 1))
+STREAM_RESERVED_THREADS = int(os.environ.get("STREAM_RESERVED_THREADS", 4))
+STREAM_PUSH_INTERVAL = float(os.environ.get("STREAM_PUSH_INTERVAL", 0.5))  # local changes are coalesced this long
+STREAM_SYNC_INTERVAL = float(os.environ.get("STREAM_SYNC_INTERVAL", 2.0))  # how often other workers' writes are picked up
+STREAM_KEEPALIVE = 15  # seconds between keep-alive comments
+MAX_STREAM_CLIENTS = max(min(
+    int(os.environ.get("MAX_STREAM_CLIENTS", 200)), WORKER_THREADS - STREAM_RESERVED_THREADS
+), 0)  # per worker, extra clients fall back to polling; 0 = no streams
+
+# Live state behind /stats and paged /get_data
+LIVE_IDLE_TIMEOUT = 60  # stop the live loop this long after the last read (if nobody streams)
+PAGE_DEFAULT_LIMIT = 100
+PAGE_MAX_LIMIT = 1000
+PAGE_ARGS = ("limit", "offset", "cursor", "sort", "device", "status")
+STATS_RATE_WINDOW = float(os.environ.get("STATS_RATE_WINDOW", 10.0))  # seconds of smoothing for diamonds/sec
+
+# Per-user diamond history, kept in memory per worker (12 bytes per point).
+# Each worker records the heartbeats it receives plus whatever the live loop
+# syncs from the others, so /history is only as fine as that sync elsewhere
+HISTORY_RESOLUTION = int(os.environ.get("HISTORY_RESOLUTION", 15))  # seconds per stored point
+HISTORY_POINTS = int(os.environ.get("HISTORY_POINTS", 240))  # points kept per user (1 hour at 15s)
+HISTORY_MAX_USERS = int(os.environ.get("HISTORY_MAX_USERS", 10000))  # least recently updated users are evicted beyond this (~30 MB per worker when all are full)
+HISTORY_MAX_BUCKETS = 1000
+
+# Prometheus metrics: each worker publishes its counters to a file, /metrics sums them
+METRICS_PATH = os.environ.get(
+    "METRICS_PATH", os.path.join(STATE_DIR, "metrics")
+)
+METRICS_WRITE_INTERVAL = float(os.environ.get("METRICS_WRITE_INTERVAL", 2.0))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Sampled profiling: 1 in PROFILE_SAMPLE requests, plus any carrying "X-Profile: <PROFILE_TOKEN>"
+PROFILE_SAMPLE = int(os.environ.get("PROFILE_SAMPLE", 0))  # 0 = no sampling
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")  # also required (as X-Profile) to read /debug/profile; unset = no access
+PROFILE_TOP = 25  # functions listed per route
+
+# /delete_users sends username lists to Supabase in chunks this size (keeps URLs short)
+BULK_DELETE_CHUNK = 200
+
+# Background sweeper deleting long-gone users; one worker per host runs it
+SWEEP_RETENTION = int(os.environ.get("SWEEP_RETENTION", 0))  # seconds since last heartbeat, 0 = off
+if SWEEP_RETENTION:
+    SWEEP_RETENTION = max(SWEEP_RETENTION, math.ceil(OFFLINE_AFTER))  # never sweep users still shown online
+SWEEP_INTERVAL = float(os.environ.get("SWEEP_INTERVAL", 60.0))
+SWEEP_BATCH = int(os.environ.get("SWEEP_BATCH", 500))  # rows per delete
+SWEEP_LOCK_PATH = os.environ.get(
+    "SWEEP_LOCK_PATH", os.path.join(STATE_DIR, "sweeper.lock")
+)
+
+# Export to SheetDB runs as a background job; status and incremental state live in files
+EXPORT_PAGE_ROWS = int(os.environ.get("EXPORT_PAGE_ROWS", 1000))  # rows per Supabase page
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", 500))  # rows per SheetDB request
+EXPORT_RETRIES = int(os.environ.get("EXPORT_RETRIES", 4))
+EXPORT_BACKOFF = float(os.environ.get("EXPORT_BACKOFF", 1.0))  # seconds before the first retry, doubled after each
+EXPORT_TIMEOUT = float(os.environ.get("EXPORT_TIMEOUT", 30.0))  # per SheetDB request
+EXPORT_JOB_RETENTION = 24 * 3600  # seconds a finished job's status is kept
+EXPORT_STALL_TIMEOUT = float(os.environ.get("EXPORT_STALL_TIMEOUT", 600.0))  # seconds without progress before a job is failed
+EXPORT_PATH = os.environ.get(
+    "EXPORT_PATH", os.path.join(STATE_DIR, "export")
+)
+
 # Supabase Configuration
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
@@ -25,9 +182,6 @@ if not SUPABASE_URL or not SUPABASE_KEY:
 # Initialize Supabase client
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-# Table name in Supabase
-TABLE_NAME = "users"
-
 def init_db():
     """
     Create table in Supabase if it doesn't exist.
@@ -36,12 +190,19 @@ def init_db():
     CREATE TABLE IF NOT EXISTS users (
         username TEXT PRIMARY KEY,
         diamonds TEXT,
+        diamonds_total BIGINT,
+        diamonds_items JSONB,
         device TEXT,
         timestamp BIGINT
     );
     
     CREATE INDEX IF NOT EXISTS idx_timestamp ON users(timestamp);
     CREATE INDEX IF NOT EXISTS idx_device ON users(device);
+
+    Existing tables need the parsed diamond columns added:
+
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS diamonds_total BIGINT;
+    ALTER TABLE users ADD COLUMN IF NOT EXISTS diamonds_items JSONB;
     """
     print("📊 Make sure to create the 'users' table in Supabase SQL Editor")
     print("   See init_db() function for SQL commands")
@@ -57,7 +218,6 @@ HTML_TEMPLATE = """
     <title>Diamond Monitor</title>
     <script crossorigin src="https://unpkg.com/react@18/umd/react.production.min.js"></script>
     <script crossorigin src="https://unpkg.com/react-dom@18/umd/react-dom.production.min.js"></script>
-    <script src="https://unpkg.com/@babel/standalone/babel.min.js"></script>
     <script src="https://cdn.tailwindcss.com"></script>
     <style>
         body { 
@@ -80,8 +240,35 @@ HTML_TEMPLATE = """
 <body>
     <div id="root"></div>
 
-    <script type="text/babel">
-        const { useState, useEffect, useCallback, useMemo, memo } = React;
+    <!-- STREAM_FLAG -->
+    <!-- APP_SCRIPT -->
+</body>
+</html>
+"""
+
+# Dashboard React app (JSX). Compiled to plain JS once at startup when dukpy
+# is installed, otherwise shipped as-is for Babel to compile in the browser.
+APP_JSX = """
+        const { useState, useEffect, useCallback, useMemo, useRef, memo } = React;
+
+        // /get_data users come as row objects or, with format=columnar, as
+        // one array per field with device/status dictionary-encoded
+        const decodeUsers = (users) => {
+            if (Array.isArray(users)) return users;
+            const { columns, dictionaries, count } = users;
+            const rows = new Array(count);
+            for (let i = 0; i < count; i++) {
+                rows[i] = {
+                    username: columns.username[i],
+                    diamonds: columns.diamonds[i],
+                    diamonds_total: columns.diamonds_total[i],
+                    device: dictionaries.device[columns.device[i]],
+                    status: dictionaries.status[columns.status[i]],
+                    last_seen: columns.last_seen[i]
+                };
+            }
+            return rows;
+        };
 
         const StatCard = memo(({ title, value, gradient, children }) => (
             <div className={`stat-card relative overflow-hidden rounded-2xl p-6 ${gradient} backdrop-blur-sm`}>
@@ -123,8 +310,11 @@ HTML_TEMPLATE = """
             </div>
         ));
 
-        const UserRow = memo(({ user, onDelete }) => (
-            <tr className="user-row border-b border-slate-800/50 hover:bg-slate-800/30 transition-all duration-200">
+        const UserRow = memo(({ user, onDelete, selected, onToggle }) => (
+            <tr
+                className="user-row whitespace-nowrap border-b border-slate-800/50 hover:bg-slate-800/30 transition-all duration-200"
+                style={{ height: ROW_HEIGHT }}
+            >
                 <td className="px-6 py-4 text-center">
                     <div className="flex justify-center items-center">
                         <div
@@ -161,7 +351,13 @@ HTML_TEMPLATE = """
                     </div>
                 </td>
                 <td className="px-6 py-4 text-center">
-                    <div className="flex justify-center items-center">
+                    <div className="flex justify-center items-center gap-3">
+                        <input
+                            type="checkbox"
+                            checked={selected}
+                            onChange={() => onToggle(user.username)}
+                            className="w-4 h-4 accent-rose-500 cursor-pointer"
+                        />
                         <button
                             onClick={() => onDelete(user.username)}
                             className="px-3 py-1.5 bg-rose-600/20 hover:bg-rose-600/30 border border-rose-500/50 text-rose-400 rounded-lg text-xs font-medium transition-all duration-200"
@@ -173,6 +369,201 @@ HTML_TEMPLATE = """
             </tr>
         ));
 
+        const ROW_HEIGHT = 64;  // px, fixed so the visible window can be computed from scrollTop
+        const OVERSCAN = 8;
+
+        // [start, end) of the rows visible in a scrolling container
+        const useVisibleRange = (scrollRef, count) => {
+            const [viewport, setViewport] = useState({ top: 0, height: 800 });
+
+            useEffect(() => {
+                const element = scrollRef.current;
+                let frame = null;
+                const measure = () => {
+                    frame = null;
+                    const top = element.scrollTop;
+                    const height = element.clientHeight;
+                    setViewport(prev => (prev.top === top && prev.height === height ? prev : { top, height }));
+                };
+                const schedule = () => {
+                    if (frame === null) frame = requestAnimationFrame(measure);
+                };
+
+                measure();
+                element.addEventListener('scroll', schedule, { passive: true });
+                window.addEventListener('resize', schedule);
+                return () => {
+                    element.removeEventListener('scroll', schedule);
+                    window.removeEventListener('resize', schedule);
+                    if (frame !== null) cancelAnimationFrame(frame);
+                };
+            }, [scrollRef]);
+
+            const start = Math.max(Math.floor(viewport.top / ROW_HEIGHT) - OVERSCAN, 0);
+            const end = Math.min(Math.ceil((viewport.top + viewport.height) / ROW_HEIGHT) + OVERSCAN, count);
+            return [start, end];
+        };
+
+        // Only the rows in view (plus some overscan) are mounted; spacer rows
+        // keep the scrollbar true to the full list
+        const UserTable = memo(({ users, isLoading, selected, sortConfig, onSort, onDelete, onToggle }) => {
+            const scrollRef = useRef(null);
+            const [start, end] = useVisibleRange(scrollRef, users.length);
+
+            return (
+                <div className="bg-slate-900/50 backdrop-blur-xl rounded-2xl overflow-hidden border border-slate-700/50 shadow-2xl fade-in">
+                    <div ref={scrollRef} className="overflow-auto" style={{ maxHeight: '70vh' }}>
+                        <table className="w-full">
+                            <thead className="sticky top-0 z-10">
+                                <tr className="bg-slate-800 border-b border-slate-700/50">
+                                    <th className="px-6 py-4 text-center text-xs font-semibold text-slate-300 uppercase tracking-wider">
+                                        Status
+                                    </th>
+                                    <th className="px-6 py-4 text-center text-xs font-semibold text-slate-300 uppercase tracking-wider">
+                                        Device
+                                    </th>
+                                    <th className="px-6 py-4 text-center text-xs font-semibold text-slate-300 uppercase tracking-wider">
+                                        Username
+                                    </th>
+                                    <th
+                                        onClick={() => onSort('diamonds')}
+                                        className="px-6 py-4 text-center text-xs font-semibold text-slate-300 uppercase tracking-wider cursor-pointer select-none"
+                                    >
+                                        Diamonds
+                                        <span className="ml-1 text-slate-500">
+                                            {sortConfig.key === 'diamonds'
+                                                ? sortConfig.direction === 'desc'
+                                                    ? '▼'
+                                                    : '▲'
+                                                : ''}
+                                        </span>
+                                    </th>
+                                    <th className="px-6 py-4 text-center text-xs font-semibold text-slate-300 uppercase tracking-wider">
+                                        Actions
+                                    </th>
+                                </tr>
+                            </thead>
+                            <tbody>
+                                {isLoading ? (
+                                    <tr>
+                                        <td colSpan="5" className="px-6 py-16 text-center">
+                                            <div className="flex flex-col items-center gap-4">
+                                                <div className="w-16 h-16 border-4 border-slate-700 border-t-cyan-500 rounded-full animate-spin"></div>
+                                                <span className="text-slate-500 text-sm font-medium">Loading...</span>
+                                            </div>
+                                        </td>
+                                    </tr>
+                                ) : users.length === 0 ? (
+                                    <tr>
+                                        <td colSpan="5" className="px-6 py-16 text-center">
+                                            <span className="text-slate-500 text-sm font-medium">No data available</span>
+                                        </td>
+                                    </tr>
+                                ) : (
+                                    <React.Fragment>
+                                        {start > 0 && <tr style={{ height: start * ROW_HEIGHT }}></tr>}
+                                        {users.slice(start, end).map(user => (
+                                            <UserRow
+                                                key={user.username}
+                                                user={user}
+                                                onDelete={onDelete}
+                                                selected={!!selected[user.username]}
+                                                onToggle={onToggle}
+                                            />
+                                        ))}
+                                        {end < users.length && <tr style={{ height: (users.length - end) * ROW_HEIGHT }}></tr>}
+                                    </React.Fragment>
+                                )}
+                            </tbody>
+                        </table>
+                    </div>
+                </div>
+            );
+        });
+
+        // Table order: ONLINE first, then the chosen column. Username breaks
+        // ties, so each user has exactly one place and binary search finds it.
+        const makeCompare = ({ key, direction }) => (a, b) => {
+            if (a.status !== b.status) {
+                return a.status === 'ONLINE' ? -1 : 1;
+            }
+            if (key === 'diamonds' && a.diamondsTotal !== b.diamondsTotal) {
+                return direction === 'asc' ? a.diamondsTotal - b.diamondsTotal : b.diamondsTotal - a.diamondsTotal;
+            }
+            return a.username.localeCompare(b.username);
+        };
+
+        const lowerBound = (list, user, compare) => {
+            let low = 0;
+            let high = list.length;
+            while (low < high) {
+                const mid = (low + high) >> 1;
+                if (compare(list[mid], user) < 0) low = mid + 1;
+                else high = mid;
+            }
+            return low;
+        };
+
+        // Move only the users whose object changed since the last order was
+        // built; past a few percent of the table a full sort is cheaper
+        const updateOrder = (order, prevUsers, users, compare) => {
+            const changed = [];
+            for (const username in prevUsers) {
+                if (prevUsers[username] !== users[username]) changed.push(username);
+            }
+            for (const username in users) {
+                if (!(username in prevUsers)) changed.push(username);
+            }
+            if (changed.length === 0) return order;
+            if (changed.length > 64 && changed.length * 16 > order.length) {
+                return Object.values(users).sort(compare);
+            }
+
+            const next = order.slice();
+            for (let i = 0; i < changed.length; i++) {
+                const previous = prevUsers[changed[i]];
+                const user = users[changed[i]];
+                if (previous) {
+                    const index = lowerBound(next, previous, compare);
+                    if (next[index] !== previous) return Object.values(users).sort(compare);
+                    next.splice(index, 1);
+                }
+                if (user) next.splice(lowerBound(next, user, compare), 0, user);
+            }
+            return next;
+        };
+
+        // Min-heap of [offline deadline, username] so the per-second status
+        // check only looks at users that are due
+        const heapPush = (heap, item) => {
+            heap.push(item);
+            let i = heap.length - 1;
+            while (i > 0) {
+                const parent = (i - 1) >> 1;
+                if (heap[parent][0] <= item[0]) break;
+                heap[i] = heap[parent];
+                i = parent;
+            }
+            heap[i] = item;
+        };
+
+        const heapPop = (heap) => {
+            const top = heap[0];
+            const last = heap.pop();
+            if (heap.length === 0) return top;
+            let i = 0;
+            while (true) {
+                let child = 2 * i + 1;
+                if (child >= heap.length) break;
+                if (child + 1 < heap.length && heap[child + 1][0] < heap[child][0]) child++;
+                if (heap[child][0] >= last[0]) break;
+                heap[i] = heap[child];
+                i = child;
+            }
+            heap[i] = last;
+            return top;
+        };
+
         const DiamondMonitor = () => {
             const [users, setUsers] = useState({});
             const [connectionStatus, setConnectionStatus] = useState('connecting');
@@ -187,45 +578,71 @@ HTML_TEMPLATE = """
             const [isLoading, setIsLoading] = useState(true);
             const [showPopup, setShowPopup] = useState(false);
             const [sheetUrl, setSheetUrl] = useState("");
+            const [incrementalExport, setIncrementalExport] = useState(false);
+            const [selected, setSelected] = useState({});
             const [sortConfig, setSortConfig] = useState({ key: 'diamonds', direction: 'desc' });
-            const [prevDiamonds, setPrevDiamonds] = useState(0);
             const [diamondsPerSecond, setDiamondsPerSecond] = useState(0);
             const STATUS_TIMEOUT = 30000;
+            const cursorRef = useRef(0);
+            const expiryRef = useRef([]);
+            const orderRef = useRef({ users: {}, sortConfig: null, list: [] });
+
+            const applyDelta = useCallback((delta) => {
+                cursorRef.current = delta.cursor;
+                const now = Date.now();
+                
+                setLastUpdate(new Date().toLocaleTimeString('th-TH'));
+                setConnectionStatus('connected');
+                setIsLoading(false);
+                
+                setUsers(prevUsers => {
+                    const expiry = expiryRef.current;
+                    if (delta.reset) expiry.length = 0;
+                    const updatedUsers = delta.reset ? {} : { ...prevUsers };
+                    delta.deleted.forEach(username => {
+                        delete updatedUsers[username];
+                    });
+                    decodeUsers(delta.users).forEach(data => {
+                        const username = data.username || 'Unknown';
+                        const lastUpdate = now - data.last_seen * 1000;
+                        
+                        updatedUsers[username] = {
+                            username,
+                            diamonds: formatDiamonds(data.diamonds),
+                            diamondsTotal: data.diamonds_total || 0,
+                            device: data.device || 'Unknown',
+                            lastUpdate,
+                            status: data.status || 'OFFLINE'
+                        };
+                        if (data.status === 'ONLINE') heapPush(expiry, [lastUpdate + STATUS_TIMEOUT, username]);
+                    });
+                    // Users that only checked in: just their liveness changed
+                    Object.keys(delta.seen || {}).forEach(username => {
+                        const user = updatedUsers[username];
+                        if (!user) return;
+                        const lastUpdate = now - delta.seen[username] * 1000;
+                        const status = now - lastUpdate <= STATUS_TIMEOUT ? 'ONLINE' : 'OFFLINE';
+                        updatedUsers[username] = { ...user, lastUpdate, status };
+                        if (status === 'ONLINE') heapPush(expiry, [lastUpdate + STATUS_TIMEOUT, username]);
+                    });
+                    return updatedUsers;
+                });
+            }, []);
 
             const fetchData = useCallback(async () => {
                 const controller = new AbortController();
                 const timeoutId = setTimeout(() => controller.abort(), 5000);
 
                 try {
-                    const response = await fetch('/get_data', {
+                    const response = await fetch(`/get_data?since=${cursorRef.current}&format=columnar`, {
                         signal: controller.signal,
                         headers: { 'Accept': 'application/json' }
                     });
                     clearTimeout(timeoutId);
                     
-                    const dataList = await response.json();
-                    const now = Date.now();
-                    
-                    setLastUpdate(new Date().toLocaleTimeString('th-TH'));
-                    setConnectionStatus('connected');
-                    setIsLoading(false);
-                    
-                    setUsers(prevUsers => {
-                        const updatedUsers = { ...prevUsers };
-                        dataList.forEach(data => {
-                            const username = data.username || 'Unknown';
-                            const lastUpdate = now - data.last_seen * 1000;
-                            
-                            updatedUsers[username] = {
-                                username,
-                                diamonds: formatDiamonds(data.diamonds),
-                                device: data.device || 'Unknown',
-                                lastUpdate,
-                                status: data.status || 'OFFLINE'
-                            };
-                        });
-                        return updatedUsers;
-                    });
+                    const delta = await response.json();
+                    if (!response.ok) throw new Error(delta.message || response.statusText);
+                    applyDelta(delta);
                     
                 } catch (error) {
                     if (error.name !== 'AbortError') {
@@ -235,7 +652,7 @@ HTML_TEMPLATE = """
                 } finally {
                     clearTimeout(timeoutId);
                 }
-            }, []);
+            }, [applyDelta]);
 
             const formatDiamonds = useMemo(() => (diamonds) => {
                 try {
@@ -251,66 +668,51 @@ HTML_TEMPLATE = """
                 }
             }, []);
 
+            const applyStats = useCallback((data) => {
+                const { devices, diamonds_per_second, ...totals } = data;
+                setStats(totals);
+                setDeviceStats(devices);
+                setDiamondsPerSecond(diamonds_per_second);
+            }, []);
+
+            const fetchStats = useCallback(async () => {
+                try {
+                    const response = await fetch('/stats', { headers: { 'Accept': 'application/json' } });
+                    if (response.ok) applyStats(await response.json());
+                } catch (error) {
+                    console.error('Stats error:', error);
+                }
+            }, [applyStats]);
+
             const updateTimeAndStatus = useCallback(() => {
                 requestAnimationFrame(() => {
                     const now = Date.now();
-                    
+                    const expiry = expiryRef.current;
+                    if (expiry.length === 0 || expiry[0][0] >= now) return;
+
+                    // Only users that just went OFFLINE get a new object; no flips, no re-render
                     setUsers(prevUsers => {
-                        const updated = { ...prevUsers };
-                        let online = 0, offline = 0, totalDiamonds = 0;
-                        const devStats = {};
-                        
-                        for (const username in updated) {
-                            const user = updated[username];
-                            const timeSinceUpdate = now - user.lastUpdate;
-                            const isOnline = timeSinceUpdate <= STATUS_TIMEOUT;
-                            
-                            updated[username] = { ...user, status: isOnline ? 'ONLINE' : 'OFFLINE' };
-                            
-                            isOnline ? online++ : offline++;
-                            
-                            let userDiamonds = 0;
-                            const diamondStr = user.diamonds;
-
-                            if (/^\\d+$/.test(diamondStr)) {
-                                userDiamonds = parseInt(diamondStr, 10);
-                            } else if (diamondStr.includes('=')) {
-                                const matches = [...diamondStr.matchAll(/=(\d+)/g)];
-                                userDiamonds = matches.reduce((sum, m) => sum + parseInt(m[1], 10), 0);
-                            }                
-                            totalDiamonds += userDiamonds;
-                            
-                            const device = user.device || 'Unknown';
-                            if (!devStats[device]) {
-                                devStats[device] = { total: 0, online: 0, diamonds: 0 };
-                            }
-                            devStats[device].total++;
-                            if (isOnline) devStats[device].online++;
-                            devStats[device].diamonds += userDiamonds;
+                        let updated = null;
+                        while (expiry.length > 0 && expiry[0][0] < now) {
+                            const username = heapPop(expiry)[1];
+                            const user = prevUsers[username];
+                            // Deleted, or seen again since (a later entry covers it)
+                            if (!user || user.status !== 'ONLINE' || now - user.lastUpdate <= STATUS_TIMEOUT) continue;
+                            if (!updated) updated = { ...prevUsers };
+                            updated[username] = { ...user, status: 'OFFLINE' };
                         }
-                        
-                        setStats({
-                            total: Object.keys(updated).length,
-                            online,
-                            offline,
-                            diamonds: totalDiamonds
-                        });
-                        setDeviceStats(devStats);
-
-                        // Calculate diamonds per second
-                        setPrevDiamonds(prev => {
-                            if (prev > 0) {
-                                const diff = totalDiamonds - prev;
-                                setDiamondsPerSecond(diff);
-                            }
-                            return totalDiamonds;
-                        });
-
-                        return updated;
+                        return updated || prevUsers;
                     });
                 });
             }, [STATUS_TIMEOUT]);
 
+            const handleSort = useCallback((key) => {
+                setSortConfig(prev => ({
+                    key,
+                    direction: prev.key === key && prev.direction === 'desc' ? 'asc' : 'desc'
+                }));
+            }, []);
+
             const handleDeleteUser = useCallback(async (username) => {
                 if (!confirm(`ต้องการลบ ${username} ใช่หรือไม่?`)) return;
                 
@@ -333,6 +735,42 @@ HTML_TEMPLATE = """
                 }
             }, []);
 
+            const handleToggleSelect = useCallback((username) => {
+                setSelected(prev => {
+                    const next = { ...prev };
+                    if (next[username]) delete next[username];
+                    else next[username] = true;
+                    return next;
+                });
+            }, []);
+
+            const handleDeleteSelected = useCallback(async () => {
+                const usernames = Object.keys(selected);
+                if (!confirm(`ต้องการลบ ${usernames.length} ผู้ใช้ที่เลือกใช่หรือไม่?`)) return;
+
+                try {
+                    // One request for the whole selection
+                    const response = await fetch('/delete_users', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify({ usernames })
+                    });
+
+                    if (response.ok) {
+                        setUsers(prev => {
+                            const updated = { ...prev };
+                            usernames.forEach(username => {
+                                delete updated[username];
+                            });
+                            return updated;
+                        });
+                        setSelected({});
+                    }
+                } catch (error) {
+                    alert('เกิดข้อผิดพลาด: ' + error.message);
+                }
+            }, [selected]);
+
             const handleDeleteAll = useCallback(async () => {
                 if (!confirm('⚠️ ต้องการลบข้อมูลทั้งหมดใช่หรือไม่?')) return;
                 
@@ -367,56 +805,89 @@ HTML_TEMPLATE = """
                 const res = await fetch("/export_to_sheet", {
                     method: "POST",
                     headers: { "Content-Type": "application/json" },
-                    body: JSON.stringify({ api_url: sheetUrl }),
+                    body: JSON.stringify({ api_url: sheetUrl, mode: incrementalExport ? "incremental" : "full" }),
                 });
-                const data = await res.json();
-                alert(data.message || "ส่งข้อมูลสำเร็จ");
+                let data = await res.json();
                 setShowPopup(false);
                 setSheetUrl("");
+                // The export runs in the background: poll the job until it finishes, or give up after an hour
+                if (res.status === 202) {
+                    const statusUrl = data.status_url;
+                    const deadline = Date.now() + 60 * 60 * 1000;
+                    do {
+                        if (Date.now() > deadline) {
+                            throw new Error("หมดเวลารอผลการส่งข้อมูล");
+                        }
+                        await new Promise(resolve => setTimeout(resolve, 2000));
+                        data = await (await fetch(statusUrl)).json();
+                    } while (data.status === "queued" || data.status === "running");
+                }
+                alert(data.message || "ส่งข้อมูลสำเร็จ");
                 } catch (err) {
                 alert("เกิดข้อผิดพลาดในการส่งข้อมูล: " + err.message);
                 }
             };
 
             useEffect(() => {
-                const fetchInterval = setInterval(fetchData, 2000);
+                let fetchInterval = null;
+                const poll = () => {
+                    fetchData();
+                    fetchStats();
+                };
+                const startPolling = () => {
+                    if (fetchInterval) return;
+                    poll();
+                    fetchInterval = setInterval(poll, 2000);
+                };
+                const stopPolling = () => {
+                    clearInterval(fetchInterval);
+                    fetchInterval = null;
+                };
+
+                // Push updates over SSE where the server offers it; poll only while the stream is down
+                let source = null;
+                if (window.EventSource && window.STREAM_ENABLED) {
+                    source = new EventSource('/stream');
+                    source.addEventListener('delta', (e) => {
+                        stopPolling();
+                        applyDelta(JSON.parse(e.data));
+                    });
+                    source.addEventListener('status', (e) => {
+                        const { online = [], offline } = JSON.parse(e.data);
+                        setUsers(prev => {
+                            const updated = { ...prev };
+                            offline.forEach(username => {
+                                if (updated[username]) updated[username] = { ...updated[username], status: 'OFFLINE' };
+                            });
+                            online.forEach(username => {
+                                if (updated[username]) updated[username] = { ...updated[username], status: 'ONLINE' };
+                            });
+                            return updated;
+                        });
+                    });
+                    source.addEventListener('stats', (e) => applyStats(JSON.parse(e.data)));
+                    source.onerror = startPolling;
+                } else {
+                    startPolling();
+                }
+
                 const updateInterval = setInterval(updateTimeAndStatus, 1000);
                 
-                fetchData();
-                
                 return () => {
-                    clearInterval(fetchInterval);
+                    if (source) source.close();
+                    stopPolling();
                     clearInterval(updateInterval);
                 };
-            }, [fetchData, updateTimeAndStatus]);
+            }, [fetchData, fetchStats, applyDelta, applyStats, updateTimeAndStatus]);
 
             const sortedUsers = useMemo(() => {
-                const userArray = Object.values(users);
-
-                userArray.sort((a, b) => {
-                    if (a.status !== b.status) {
-                        return a.status === 'ONLINE' ? -1 : 1;
-                    }
-
-                    if (sortConfig.key === 'diamonds') {
-                        const parseDiamonds = (d) => {
-                            let total = 0;
-                            if (/^\d+$/.test(d)) total = parseInt(d, 10);
-                            else if (d.includes('=')) {
-                                const matches = d.matchAll(/=(\d+)/g);
-                                for (const match of matches) total += parseInt(match[1], 10);
-                            }
-                            return total;
-                        };
-                        const aVal = parseDiamonds(a.diamonds);
-                        const bVal = parseDiamonds(b.diamonds);
-                        return sortConfig.direction === 'asc' ? aVal - bVal : bVal - aVal;
-                    }
-
-                    return a.username.localeCompare(b.username);
-                });
-
-                return userArray;
+                const previous = orderRef.current;
+                const compare = makeCompare(sortConfig);
+                const list = previous.sortConfig === sortConfig
+                    ? updateOrder(previous.list, previous.users, users, compare)
+                    : Object.values(users).sort(compare);
+                orderRef.current = { users, sortConfig, list };
+                return list;
             }, [users, sortConfig]);
 
             const sortedDeviceStats = useMemo(() => {
@@ -461,6 +932,15 @@ HTML_TEMPLATE = """
                                         className="w-full px-3 py-2 rounded-lg bg-slate-800 text-slate-100 border border-cyan-600 focus:outline-none focus:ring focus:ring-cyan-400/50"
                                         />
 
+                                        <label className="flex items-center gap-2 mt-3 text-slate-300 text-sm">
+                                        <input
+                                            type="checkbox"
+                                            checked={incrementalExport}
+                                            onChange={(e) => setIncrementalExport(e.target.checked)}
+                                        />
+                                        ส่งเฉพาะผู้ใช้ที่ยอดเพชรเปลี่ยนตั้งแต่ครั้งก่อน
+                                        </label>
+
                                         <div className="flex justify-end gap-2 mt-4">
                                         <button
                                             onClick={() => setShowPopup(false)}
@@ -479,6 +959,14 @@ HTML_TEMPLATE = """
                                     </div>
                                 )}
                                 </div>
+                                    {Object.keys(selected).length > 0 && (
+                                        <button
+                                            onClick={handleDeleteSelected}
+                                            className="px-4 py-2 bg-rose-600/20 hover:bg-rose-600/30 border border-rose-500/50 text-rose-400 rounded-lg text-sm font-medium transition-all duration-200"
+                                        >
+                                            🗑️ Delete Selected ({Object.keys(selected).length})
+                                        </button>
+                                    )}
                                     <button
                                         onClick={handleCleanupOffline}
                                         className="px-4 py-2 bg-orange-600/20 hover:bg-orange-600/30 border border-orange-500/50 text-orange-400 rounded-lg text-sm font-medium transition-all duration-200"
@@ -562,7 +1050,7 @@ HTML_TEMPLATE = """
                                 gradient="bg-gradient-to-br from-cyan-600/20 to-blue-600/20 border border-cyan-500/30"
                             >
                                 <p className="text-sm text-cyan-400 mt-2 flex items-center gap-1">
-                                    ↗ {(stats.diamonds / 2).toFixed(0)} / 30 sec
+                                    ↗ {(diamondsPerSecond * 30).toFixed(0)} / 30 sec
                                 </p>
                             </StatCard>
                         </div>
@@ -577,70 +1065,15 @@ HTML_TEMPLATE = """
                             </div>
                         )}
 
-                        <div className="bg-slate-900/50 backdrop-blur-xl rounded-2xl overflow-hidden border border-slate-700/50 shadow-2xl fade-in">
-                            <div className="overflow-x-auto">
-                                <table className="w-full">
-                                    <thead>
-                                        <tr className="bg-slate-800/80 border-b border-slate-700/50">
-                                            <th className="px-6 py-4 text-center text-xs font-semibold text-slate-300 uppercase tracking-wider">
-                                                Status
-                                            </th>
-                                            <th className="px-6 py-4 text-center text-xs font-semibold text-slate-300 uppercase tracking-wider">
-                                                Device
-                                            </th>
-                                            <th className="px-6 py-4 text-center text-xs font-semibold text-slate-300 uppercase tracking-wider">
-                                                Username
-                                            </th>
-                                            <th
-                                                onClick={() => setSortConfig(prev => ({
-                                                    key: 'diamonds',
-                                                    direction: prev.key === 'diamonds' && prev.direction === 'desc' ? 'asc' : 'desc'
-                                                }))}
-                                                className="px-6 py-4 text-center text-xs font-semibold text-slate-300 uppercase tracking-wider cursor-pointer select-none"
-                                            >
-                                                Diamonds
-                                                <span className="ml-1 text-slate-500">
-                                                    {sortConfig.key === 'diamonds'
-                                                        ? sortConfig.direction === 'desc'
-                                                            ? '▼'
-                                                            : '▲'
-                                                        : ''}
-                                                </span>
-                                            </th>
-                                            <th className="px-6 py-4 text-center text-xs font-semibold text-slate-300 uppercase tracking-wider">
-                                                Actions
-                                            </th>
-                                        </tr>
-                                    </thead>
-                                    <tbody>
-                                        {isLoading ? (
-                                            <tr>
-                                                <td colSpan="5" className="px-6 py-16 text-center">
-                                                    <div className="flex flex-col items-center gap-4">
-                                                        <div className="w-16 h-16 border-4 border-slate-700 border-t-cyan-500 rounded-full animate-spin"></div>
-                                                        <span className="text-slate-500 text-sm font-medium">Loading...</span>
-                                                    </div>
-                                                </td>
-                                            </tr>
-                                        ) : sortedUsers.length === 0 ? (
-                                            <tr>
-                                                <td colSpan="5" className="px-6 py-16 text-center">
-                                                    <span className="text-slate-500 text-sm font-medium">No data available</span>
-                                                </td>
-                                            </tr>
-                                        ) : (
-                                            sortedUsers.map(user => (
-                                                <UserRow 
-                                                    key={user.username} 
-                                                    user={user} 
-                                                    onDelete={handleDeleteUser}
-                                                />
-                                            ))
-                                        )}
-                                    </tbody>
-                                </table>
-                            </div>
-                        </div>
+                        <UserTable
+                            users={sortedUsers}
+                            isLoading={isLoading}
+                            selected={selected}
+                            sortConfig={sortConfig}
+                            onSort={handleSort}
+                            onDelete={handleDeleteUser}
+                            onToggle={handleToggleSelect}
+                        />
 
                         <div className="mt-6 text-center">
                             <div className="inline-flex items-center gap-2 px-4 py-2 rounded-lg bg-slate-800/50 border border-slate-700/50 text-slate-400 text-xs font-medium">
@@ -655,192 +1088,2501 @@ HTML_TEMPLATE = """
         };
 
         ReactDOM.render(<DiamondMonitor />, document.getElementById('root'));
-    </script>
-</body>
-</html>
 """
 
-# Cache for get_data endpoint
-_cache = {'data': None, 'timestamp': 0}
+def compile_frontend():
+    """
+    Return (script, precompiled). The compiled script is kept in STATE_DIR,
+    keyed by a hash of the source, so workers and restarts reuse it. It is
+    served to every dashboard, so it must not sit where other local users
+    could plant one.
+    """
+    digest = hashlib.sha256(APP_JSX.encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(STATE_DIR, f"app.{digest}.js")
 
-@app.route("/")
-def index():
-    return render_template_string(HTML_TEMPLATE)
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read(), True
+    except FileNotFoundError:
+        pass
 
-@app.route("/send_data", methods=["POST"])
-def receive_data():
     try:
-        data = request.json
-        if not data:
-            return jsonify({"status": "error", "message": "No JSON received"}), 400
-        
-        username = data.get("username", "Unknown")
-        diamonds = data.get("diamonds", 0)
-        device = data.get("device", "Unknown")
-        timestamp = int(time.time() * 1000)  # milliseconds
+        import dukpy
+    except ImportError:
+        print("⚠️  dukpy not installed, the dashboard will be compiled in the browser")
+        return APP_JSX, False
 
-        # Convert diamonds to JSON string if dict/list
-        if isinstance(diamonds, (dict, list)):
-            diamonds = json.dumps(diamonds, separators=(',', ':'))
-        else:
-            diamonds = str(diamonds)
+    try:
+        script = dukpy.jsx_compile(APP_JSX, plugins=["transform-object-rest-spread"])
+    except Exception as e:
+        print(f"[ERROR] compile_frontend: {str(e)}")
+        return APP_JSX, False
 
-        # Upsert to Supabase
-        result = supabase.table(TABLE_NAME).upsert({
-            "username": username,
-            "diamonds": diamonds,
-            "device": device,
-            "timestamp": timestamp
-        }, on_conflict="username").execute()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(script)
+    os.replace(tmp_path, path)
+    return script, True
 
-        # Invalidate cache
-        _cache['timestamp'] = 0
+def build_asset(body, mimetype):
+    """Static response bytes with their gzip variant and ETag, built once."""
+    return {
+        "body": body,
+        "gzip": gzip.compress(body, compresslevel=9),
+        "etag": hashlib.blake2b(body, digest_size=12).hexdigest(),
+        "mimetype": mimetype
+    }
 
-        return jsonify({"status": "success"}), 200
-    except Exception as e:
-        print(f"[ERROR] {str(e)}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+def encoded_response(body, etag, mimetype, gzip_body=None, cache_control="no-cache"):
+    """
+    Response for already-encoded bytes, honouring If-None-Match.
+    gzip_body is called for the compressed variant when the client accepts it.
+    """
+    response = Response(body, mimetype=mimetype)
+    response.headers["Vary"] = "Accept, Accept-Encoding"
+    response.headers["Cache-Control"] = cache_control
 
-@app.route("/get_data", methods=["GET"])
-def get_data():
-    now = time.time()
-    
-    # Check cache
-    if _cache['data'] and (now - _cache['timestamp']) < CACHE_TTL:
-        return jsonify(_cache['data'])
+    if gzip_body and "gzip" in request.headers.get("Accept-Encoding", "").lower() and len(body) > 500:
+        compressed = gzip_body()
+        inc("gzip_bytes_saved_total", len(body) - len(compressed))
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = "gzip"
+        etag += "-gzip"
 
-    try:
-        # Fetch all users from Supabase
-        response = supabase.table(TABLE_NAME).select("*").execute()
-        users = response.data
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
-        result = []
-        now_ms = int(now * 1000)
-        
-        for user in users:
-            time_diff = (now_ms - user["timestamp"]) / 1000  # convert to seconds
-            status = "ONLINE" if time_diff <= TIMEOUT else "OFFLINE"
-            
-            result.append({
-                "username": user["username"],
-                "diamonds": user["diamonds"],
-                "device": user["device"],
-                "status": status,
-                "last_seen": int(time_diff)
-            })
-        
-        # Update cache
-        _cache['data'] = result
-        _cache['timestamp'] = now
-        
-        return jsonify(result)
-    except Exception as e:
-        print(f"[ERROR] get_data: {str(e)}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+APP_SCRIPT, APP_PRECOMPILED = compile_frontend()
+_app_asset = build_asset(APP_SCRIPT.encode("utf-8"), "application/javascript")
 
-@app.route("/delete_user", methods=["POST"])
-def delete_user():
-    try:
-        data = request.json
-        username = data.get("username")
-        
-        if not username:
-            return jsonify({"status": "error", "message": "Username required"}), 400
-        
-        # Delete from Supabase
-        supabase.table(TABLE_NAME).delete().eq("username", username).execute()
-        
-        # Invalidate cache
-        _cache['timestamp'] = 0
-        
-        return jsonify({"status": "success"})
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+if APP_PRECOMPILED:
+    _app_tag = f'<script src="/app.js?v={_app_asset["etag"]}"></script>'
+else:
+    _app_tag = (
+        '<script src="https://unpkg.com/@babel/standalone/babel.min.js"></script>\n'
+        f'    <script type="text/babel" src="/app.js?v={_app_asset["etag"]}"></script>'
+    )
 
-@app.route("/delete_all", methods=["POST"])
-def delete_all():
-    try:
-        # Delete all records from Supabase
-        # Note: Supabase requires a filter, so we delete where timestamp > 0
-        supabase.table(TABLE_NAME).delete().gt("timestamp", 0).execute()
-        
-        # Invalidate cache
-        _cache['timestamp'] = 0
-        
-        return jsonify({"status": "success"})
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+def build_index(stream):
+    """The dashboard page; stream tells it whether /stream is worth opening."""
+    html = HTML_TEMPLATE.replace("<!-- APP_SCRIPT -->", _app_tag).replace(
+        "<!-- STREAM_FLAG -->", f"<script>window.STREAM_ENABLED = {'true' if stream else 'false'};</script>"
+    )
+    return build_asset(html.encode("utf-8"), "text/html")
 
-@app.route("/cleanup_offline", methods=["POST"])
-def cleanup_offline():
+_index_assets = {stream: build_index(stream) for stream in (True, False)}
+
+# Metrics: this worker's counters and histograms, keyed by (name, labels).
+# A histogram is [count per LATENCY_BUCKETS bucket..., count above, sum].
+_METRICS = {
+    "http_requests_total": ("counter", "Requests by route, method and status"),
+    "http_request_duration_seconds": ("histogram", "Time to produce a response, by route"),
+    "supabase_request_duration_seconds": ("histogram", "Supabase call latency, by operation"),
+    "supabase_errors_total": ("counter", "Failed Supabase calls, by operation"),
+    "sheetdb_request_duration_seconds": ("histogram", "SheetDB upload latency"),
+    "snapshot_cache_total": ("counter", "Snapshot lookups by mode: hit (fresh), stale (served while refreshing) or miss"),
+    "gzip_bytes_saved_total": ("counter", "Response bytes saved by gzip"),
+    "ingested_rows_total": ("counter", "Heartbeat rows accepted, by route"),
+    "heartbeats_suppressed_total": ("counter", "Unchanged heartbeats not written to Supabase"),
+    "write_rows_dropped_total": ("counter", "Buffered rows given up on after FLUSH_MAX_ATTEMPTS failed flushes")
+}
+_metrics = {}
+_metrics_lock = threading.Lock()
+_metrics_writer = {'thread': None, 'pid': None}
+
+def _metric_key(name, labels):
+    if _metrics_writer['pid'] != os.getpid():
+        _start_metrics_writer()
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, amount=1, **labels):
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        _metrics[key] = _metrics.get(key, 0) + amount
+
+def observe(name, seconds, **labels):
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        histogram = _metrics.get(key)
+        if histogram is None:
+            histogram = _metrics[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+def run_query(operation, query):
+    """query.execute(), timed and counted per operation."""
+    started = time.perf_counter()
     try:
-        now_ms = int(time.time() * 1000)
-        cutoff = now_ms - (TIMEOUT * 1000)
-        
-        # Delete offline users from Supabase
-        result = supabase.table(TABLE_NAME).delete().lt("timestamp", cutoff).execute()
-        
-        # Invalidate cache
-        _cache['timestamp'] = 0
-        
-        deleted_count = len(result.data) if result.data else 0
-        return jsonify({"status": "success", "message": f"Removed {deleted_count} offline users"})
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
-    
+        return query.execute()
+    except Exception:
+        inc("supabase_errors_total", operation=operation)
+        raise
+    finally:
+        observe("supabase_request_duration_seconds", time.perf_counter() - started, operation=operation)
 
-@app.route("/export_to_sheet", methods=["POST"])
-def export_to_sheet():
+def _pid_alive(pid):
     try:
-        import requests
-        
-        data = request.json
-        sheet_api_url = data.get("api_url")
-        
-        if not sheet_api_url:
-            return jsonify({"status": "error", "message": "API URL required"}), 400
-        
-        # Get all users from Supabase
-        response = supabase.table(TABLE_NAME).select("*").execute()
-        users = response.data
-        
-        # Prepare data for SheetDB
-        sheet_data = []
-        for user in users:
-            diamonds_str = user["diamonds"]
-            
-            # Parse diamonds to get total
-            try:
-                parsed = json.loads(diamonds_str)
-                if isinstance(parsed, dict):
-                    total = sum(int(v) for v in parsed.values())
-                else:
-                    total = int(parsed)
-            except:
-                total = 0
-            
-            sheet_data.append({
-                "username": user["username"],
-                "diamonds": str(total)
-            })
-        
-        # Send to SheetDB
-        headers = {"Content-Type": "application/json"}
-        response = requests.post(sheet_api_url, json={"data": sheet_data}, headers=headers)
-        
-        if response.status_code in [200, 201]:
-            return jsonify({
-                "status": "success", 
-                "message": f"Exported {len(sheet_data)} records to Google Sheet"
-            })
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _file_pid(path, prefix):
+    """The worker PID in a "<prefix>.<pid>.json" path, or None."""
+    pid = path[len(prefix) + 1:-len(".json")]
+    return int(pid) if pid.isdigit() else None
+
+def _merge_metrics(merged, entries):
+    for name, labels, value in entries:
+        key = (name, tuple(sorted(labels.items())))
+        if isinstance(value, list):
+            total = merged.setdefault(key, [0] * len(value))
+            merged[key] = [a + b for a, b in zip(total, value)]
         else:
-            return jsonify({
-                "status": "error", 
-                "message": f"SheetDB error: {response.text}"
-            }), 500
-            
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+            merged[key] = merged.get(key, 0) + value
+
+def retire_metrics(pids):
+    """
+    Fold exited workers' metrics files into METRICS_PATH.retired.json and
+    delete them, so their counters survive (and a new worker reusing the
+    PID can't overwrite them) without the files piling up.
+    """
+    retired_path = f"{METRICS_PATH}.retired.json"
+    with open(f"{METRICS_PATH}.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        paths = [path for path in (f"{METRICS_PATH}.{pid}.json" for pid in pids) if os.path.exists(path)]
+        if not paths:
+            return
+        merged = {}
+        for path in [retired_path] + paths:
+            try:
+                with open(path) as f:
+                    _merge_metrics(merged, json.load(f))
+            except (FileNotFoundError, ValueError):
+                continue
+        tmp_path = f"{retired_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump([[name, dict(labels), value] for (name, labels), value in merged.items()], f, separators=(',', ':'))
+        os.replace(tmp_path, retired_path)
+        for path in paths:
+            os.remove(path)
+
+def write_metrics():
+    with _metrics_lock:
+        entries = [[name, dict(labels), value] for (name, labels), value in _metrics.items()]
+    tmp_path = f"{METRICS_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entries, f, separators=(',', ':'))
+    os.replace(tmp_path, f"{METRICS_PATH}.{os.getpid()}.json")
+
+def _metrics_loop():
+    while True:
+        time.sleep(METRICS_WRITE_INTERVAL)
+        try:
+            write_metrics()
+        except OSError as e:
+            print(f"[ERROR] write_metrics: {str(e)}")
+
+def _start_metrics_writer():
+    with _metrics_lock:
+        if _metrics_writer['pid'] == os.getpid():
+            return
+        # Counters inherited through fork belong to the parent
+        _metrics.clear()
+        try:
+            # A file under our PID is left from an exited process that had it
+            retire_metrics([os.getpid()])
+        except OSError as e:
+            print(f"[ERROR] retire_metrics: {str(e)}")
+        _metrics_writer['pid'] = os.getpid()
+        thread = threading.Thread(target=_metrics_loop, name="metrics", daemon=True)
+        thread.start()
+        _metrics_writer['thread'] = thread
+
+def collect_metrics():
+    """
+    Sum every worker's published metrics. Exited workers' counts are folded
+    into the retired file first, so counters stay monotonic when gunicorn
+    replaces a worker.
+    """
+    write_metrics()
+    paths = glob.glob(f"{METRICS_PATH}.*.json")
+    dead = [pid for pid in (_file_pid(path, METRICS_PATH) for path in paths) if pid is not None and not _pid_alive(pid)]
+    if dead:
+        retire_metrics(dead)
+        paths = glob.glob(f"{METRICS_PATH}.*.json")
+
+    merged = {}
+    for path in paths:
+        try:
+            with open(path) as f:
+                _merge_metrics(merged, json.load(f))
+        except (FileNotFoundError, ValueError):
+            continue
+    return merged
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}={json.dumps(str(v))}' for k, v in labels) + "}"
+
+def render_metrics(merged):
+    lines = []
+    for name, (kind, description) in _METRICS.items():
+        series = sorted((labels, value) for (metric, labels), value in merged.items() if metric == name)
+        if not series:
+            continue
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in series:
+            if kind != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value[-1]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+# Cache for get_data endpoint: this worker's decoded copy of each shared snapshot
+_caches = {
+    mode: {
+        'rows': None, 'key': None, 'header': None,
+        'encoded': {}  # format -> {'body', 'etag', 'gzip'}
+    }
+    for mode in SNAPSHOT_MODES
+}
+_cache_lock = threading.Lock()
+_shared = {'pid': None, 'fd': None, 'mmap': None}
+_refresh = {'running': set()}  # modes refreshing in the background
+
+def snapshot_path(mode="all"):
+    return SNAPSHOT_PATH if mode == "all" else f"{SNAPSHOT_PATH}.{mode}"
+
+def snapshot_query(table, mode="all", now=None):
+    """
+    The Supabase query behind a snapshot mode, on a table query builder
+    (sync or async client). Only the columns format_user reads are fetched.
+    """
+    query = table.select(SNAPSHOT_COLUMNS)
+    if mode == "online":
+        # Served by idx_timestamp. Unchanged heartbeats are only written every
+        # HEARTBEAT_REFRESH, so rows up to that much older may still be online.
+        now_ms = int((now or time.time()) * 1000)
+        query = query.gte("timestamp", now_ms - int((TIMEOUT + max(HEARTBEAT_REFRESH, 0)) * 1000))
+    return query
+
+def _generation_map():
+    # Two 8-byte counters in a memory-mapped file, opened once per process: the
+    # generation, and the generation of the last deletion
+    if _shared['pid'] != os.getpid():
+        fd = os.open(SNAPSHOT_PATH + ".gen", os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size < 16:
+            os.ftruncate(fd, 16)
+        _shared.update(pid=os.getpid(), fd=fd, mmap=mmap.mmap(fd, 16))
+    return _shared
+
+def read_generation():
+    return struct.unpack_from("Q", _generation_map()['mmap'])[0]
+
+def read_purge_generation():
+    """Snapshots fetched before this generation may still hold deleted users."""
+    return struct.unpack_from("Q", _generation_map()['mmap'], 8)[0]
+
+def invalidate_snapshot(purge=False):
+    """
+    Mark the shared snapshots stale for every worker. purge=True (after
+    deletions) also stops them from being served stale.
+    """
+    shared = _generation_map()
+    fcntl.flock(shared['fd'], fcntl.LOCK_EX)
+    try:
+        generation = struct.unpack_from("Q", shared['mmap'])[0] + 1
+        struct.pack_into("Q", shared['mmap'], 0, generation)
+        if purge:
+            struct.pack_into("Q", shared['mmap'], 8, generation)
+    finally:
+        fcntl.flock(shared['fd'], fcntl.LOCK_UN)
+
+def _read_snapshot_file(mode="all"):
+    # Re-parse only when another worker replaced the file; call with _cache_lock held
+    cache = _caches[mode]
+    try:
+        st = os.stat(snapshot_path(mode))
+    except FileNotFoundError:
+        return None
+
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    if cache['key'] != key:
+        with open(snapshot_path(mode), "rb") as f:
+            header = json.loads(f.readline())
+            rows = json.loads(f.read())
+        cache.update(key=key, header=header, rows=rows, encoded={})
+    return cache['header']
+
+def _snapshot_fresh(header, now, generation):
+    return header is not None and header["generation"] == generation and now - header["fetched_at"] < CACHE_TTL
+
+def cached_snapshot(now, mode="all", allow_stale=True):
+    """
+    (rows, stale) from the shared snapshot without touching Supabase, or
+    (None, False) when it is missing or too stale to serve. Snapshots
+    older than the last deletion are never served stale.
+    """
+    generation = read_generation()
+    purged = read_purge_generation()
+    with _cache_lock:
+        header = _read_snapshot_file(mode)
+        if _snapshot_fresh(header, now, generation):
+            inc("snapshot_cache_total", result="hit", mode=mode)
+            return _caches[mode]['rows'], False
+        if (
+            allow_stale and header and header["generation"] >= purged
+            and now - header["fetched_at"] < CACHE_MAX_STALENESS
+        ):
+            inc("snapshot_cache_total", result="stale", mode=mode)
+            return _caches[mode]['rows'], True
+    inc("snapshot_cache_total", result="miss", mode=mode)
+    return None, False
+
+def load_snapshot(now, mode="all", allow_stale=True):
+    """
+    Raw rows of the users table. Fresh means younger than CACHE_TTL and not
+    invalidated since the fetch began. A stale snapshot younger than
+    CACHE_MAX_STALENESS is served as-is while it is refreshed in the
+    background; older than that, callers wait for a single refresh.
+    """
+    rows, stale = cached_snapshot(now, mode, allow_stale)
+    if rows is None:
+        return refresh_snapshot(wait=True, mode=mode)
+    if stale:
+        _start_background_refresh(mode)
+    return rows
+
+def reusable_snapshot(generation, waited_from, waited, mode="all"):
+    """Rows a refresher can return without fetching: fresh, or fetched while it waited."""
+    with _cache_lock:
+        header = _read_snapshot_file(mode)
+        if _snapshot_fresh(header, time.time(), generation) or (
+            waited and header and header["fetched_at"] >= waited_from
+        ):
+            return _caches[mode]['rows']
+    return None
+
+def store_snapshot(rows, generation, mode="all", fetched_at=None):
+    """Publish freshly fetched rows to every worker. Call with the snapshot lock held."""
+    header = {"generation": generation, "fetched_at": fetched_at or time.time()}
+
+    path = snapshot_path(mode)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps(header) + "\n")
+        json.dump(rows, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+    st = os.stat(path)
+    with _cache_lock:
+        _caches[mode].update(
+            key=(st.st_ino, st.st_mtime_ns, st.st_size), header=header,
+            rows=rows, encoded={}
+        )
+    return rows
+
+def refresh_snapshot(wait=True, mode="all"):
+    """
+    Refetch the snapshot unless another thread or worker is already on it.
+    Waiters block on the lock and reuse that result; with wait=False the
+    call returns None instead when a refresh is in progress.
+    """
+    lock_file = open(snapshot_path(mode) + ".lock", "a")
+    try:
+        waited_from = time.time()
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        generation = read_generation()
+        rows = reusable_snapshot(generation, waited_from, wait, mode)
+        if rows is not None:
+            return rows
+
+        # Fetch the users for this mode from Supabase
+        now = time.time()
+        response = run_query("snapshot", snapshot_query(supabase.table(TABLE_NAME), mode, now))
+        return store_snapshot(response.data, generation, mode, now)
+    finally:
+        lock_file.close()
+
+def snapshot_fetched_at(rows, mode="all"):
+    """When the given snapshot rows were fetched (None if they aren't the cached ones)."""
+    with _cache_lock:
+        cache = _caches[mode]
+        return cache['header']["fetched_at"] if cache['rows'] is rows and cache['header'] else None
+
+def _background_refresh(mode):
+    try:
+        refresh_snapshot(wait=False, mode=mode)
+    except Exception as e:
+        print(f"[ERROR] background refresh: {str(e)}")
+    finally:
+        _refresh['running'].discard(mode)
+
+def _start_background_refresh(mode="all"):
+    with _cache_lock:
+        if mode in _refresh['running']:
+            return
+        _refresh['running'].add(mode)
+    threading.Thread(target=_background_refresh, args=(mode,), name="snapshot-refresh", daemon=True).start()
+
+# Pending rows keyed by username (last write wins), flushed by a background thread
+_write_buffer = {}
+_write_attempts = {}  # username -> failed flushes of its pending row
+_write_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_flush_event = threading.Event()
+_flusher = {'thread': None, 'pid': None}
+
+BIGINT_MIN, BIGINT_MAX = -2 ** 63, 2 ** 63 - 1  # diamonds_total is a Postgres BIGINT
+
+def _clamp_count(count):
+    return min(max(count, BIGINT_MIN), BIGINT_MAX)
+
+def _to_count(value):
+    try:
+        return _clamp_count(int(value))
+    except (TypeError, ValueError, OverflowError):
+        return 0
+
+def parse_diamonds(diamonds):
+    """
+    Split a `diamonds` value (as sent, or as stored text) into (total, items).
+    Objects and lists give per-item counts, anything else is a single count.
+    """
+    if isinstance(diamonds, str):
+        try:
+            diamonds = json.loads(diamonds)
+        except ValueError:
+            return 0, {}
+
+    if isinstance(diamonds, dict):
+        entries = diamonds.items()
+    elif isinstance(diamonds, list):
+        entries = enumerate(diamonds)
+    else:
+        return _to_count(diamonds), {}
+
+    items = {str(key): _to_count(value) for key, value in entries}
+    return _clamp_count(sum(items.values())), items
+
+def row_diamonds_total(row):
+    # Rows written before diamonds_total existed still need parsing
+    total = row.get("diamonds_total")
+    if total is None:
+        total = parse_diamonds(row["diamonds"])[0]
+    return total
+
+def build_user_row(data, timestamp=None):
+    """Normalize an incoming device record into a `users` row."""
+    username = data.get("username", "Unknown")
+    diamonds = data.get("diamonds", 0)
+    device = data.get("device", "Unknown")
+    if timestamp is None:
+        timestamp = int(time.time() * 1000)  # milliseconds
+
+    diamonds_total, diamonds_items = parse_diamonds(diamonds)
+
+    # Convert diamonds to JSON string if dict/list
+    if isinstance(diamonds, (dict, list)):
+        diamonds = json.dumps(diamonds, separators=(',', ':'))
+    else:
+        diamonds = str(diamonds)
+
+    return {
+        "username": username,
+        "diamonds": diamonds,
+        "diamonds_total": diamonds_total,
+        "diamonds_items": diamonds_items,
+        "device": device,
+        "timestamp": timestamp
+    }
+
+def upsert_rows(rows):
+    """Write rows to Supabase in a single bulk upsert."""
+    if not rows:
+        return
+    run_query("upsert", supabase.table(TABLE_NAME).upsert(rows, on_conflict="username"))
+
+    # Invalidate cache
+    invalidate_snapshot()
+
+def enqueue_rows(rows):
+    """Queue rows for the next bulk upsert, coalescing per username."""
+    with _write_lock:
+        for row in rows:
+            _write_buffer[row["username"]] = row
+            _write_attempts.pop(row["username"], None)
+        pending = len(_write_buffer)
+
+    _ensure_flusher()
+    if pending >= FLUSH_MAX_ROWS:
+        _flush_event.set()
+
+def flush_write_buffer():
+    """Upsert everything pending in the write buffer. Returns the row count."""
+    with _flush_lock:
+        with _write_lock:
+            if not _write_buffer:
+                return 0
+            rows = list(_write_buffer.values())
+            _write_buffer.clear()
+
+        rejected, unsent = _upsert_isolating(rows)
+        if len(unsent) < len(rows):
+            # Rows held back through an outage can land later than the delta
+            # overlap covers; clients past their timestamp must resync
+            landed_ms = int(time.time() * 1000)
+            failed = {id(row) for row in rejected + unsent}
+            if any(row["timestamp"] < landed_ms - DELTA_OVERLAP_MS for row in rows if id(row) not in failed):
+                record_tombstones(reset=True)
+        if not rejected and not unsent:
+            return len(rows)
+
+        # Put failed rows back unless a newer heartbeat arrived meanwhile.
+        # A row Supabase keeps rejecting is dropped so it can't hold up the
+        # rest; rows that never got a verdict (outage, schema or auth
+        # trouble) are kept however long it takes
+        dropped = []
+        with _write_lock:
+            for row in unsent:
+                _write_buffer.setdefault(row["username"], row)
+            for row in rejected:
+                username = row["username"]
+                if _write_buffer.setdefault(username, row) is not row:
+                    continue
+                _write_attempts[username] = _write_attempts.get(username, 0) + 1
+                if _write_attempts[username] >= FLUSH_MAX_ATTEMPTS:
+                    del _write_buffer[username]
+                    del _write_attempts[username]
+                    dropped.append(username)
+        if dropped:
+            print(f"[ERROR] flush_write_buffer: dropped rows for {len(dropped)} users after {FLUSH_MAX_ATTEMPTS} attempts")
+            inc("write_rows_dropped_total", len(dropped))
+            forget_heartbeats(dropped)  # their next heartbeat must be written, not suppressed
+        return len(rows) - len(rejected) - len(unsent)
+
+def _is_row_error(e):
+    # Postgres data exceptions (22xxx) and constraint violations (23xxx) come
+    # from particular rows; schema (PGRST2xx), auth and permission errors don't
+    return str(e.code or "")[:2] in ("22", "23")
+
+def _upsert_isolating(rows):
+    """
+    Upsert rows and return (rejected, unsent). When Supabase rejects the
+    batch over row data, it is split in halves until the rejected rows are
+    isolated. Any other error (network, timeouts, missing columns, RLS, bad
+    key) leaves the whole batch unsent, since splitting can't help.
+    """
+    try:
+        upsert_rows(rows)
+        return [], []
+    except APIError as e:
+        if not _is_row_error(e):
+            print(f"[ERROR] flush_write_buffer: Supabase refused the whole batch, {len(rows)} rows kept for retry: {str(e)}")
+            return [], rows
+        if len(rows) == 1:
+            print(f"[ERROR] flush_write_buffer: {rows[0]['username']!r} rejected: {str(e)}")
+            return rows, []
+        middle = len(rows) // 2
+        first, second = _upsert_isolating(rows[:middle]), _upsert_isolating(rows[middle:])
+        return first[0] + second[0], first[1] + second[1]
+    except Exception as e:
+        print(f"[ERROR] flush_write_buffer: {str(e)}")
+        return [], rows
+
+def discard_pending(usernames=None):
+    """Drop buffered rows (all of them if usernames is None) so a later flush can't resurrect deleted users."""
+    with _flush_lock:  # wait out an in-flight flush
+        with _write_lock:
+            if usernames is None:
+                _write_buffer.clear()
+                _write_attempts.clear()
+            else:
+                for username in usernames:
+                    _write_buffer.pop(username, None)
+                    _write_attempts.pop(username, None)
+
+# Change suppression: what this worker last handed to Supabase per user, and
+# heartbeats received since then that changed nothing. Every worker publishes
+# its last-seen map to a file so status and last_seen stay exact host-wide.
+_persisted = {}  # username -> (diamonds, device, timestamp)
+_seen = {}  # username -> latest unwritten heartbeat (ms)
+_seen_lock = threading.Lock()
+_seen_state = {
+    'pid': None, 'thread': None, 'version': 0, 'tombstone_key': None, 'tombstone_t': 0,
+    'files': {}, 'merged': {}, 'merged_at': 0
+}
+
+def changed_rows(rows):
+    """
+    Rows that need writing: new content, or a persisted timestamp older
+    than HEARTBEAT_REFRESH. The rest only advance the last-seen map.
+    """
+    rows = list(rows)
+    if HEARTBEAT_REFRESH <= 0:
+        return rows
+    _forget_deleted()
+
+    refresh_ms = HEARTBEAT_REFRESH * 1000
+    changed = []
+    with _seen_lock:
+        for row in rows:
+            username = row["username"]
+            previous = _persisted.get(username)
+            if (
+                previous is not None and previous[:2] == (row["diamonds"], row["device"])
+                and row["timestamp"] - previous[2] < refresh_ms
+            ):
+                _seen[username] = max(_seen.get(username, 0), row["timestamp"])
+                continue
+            _persisted[username] = (row["diamonds"], row["device"], row["timestamp"])
+            _seen.pop(username, None)
+            changed.append(row)
+        _seen_state['version'] += 1
+
+    if len(changed) < len(rows):
+        inc("heartbeats_suppressed_total", len(rows) - len(changed))
+        _ensure_seen_writer()
+    return changed
+
+def store_rows(rows):
+    """Queue (or upsert) the heartbeats that changed something."""
+    rows = changed_rows(rows)
+    if not rows:
+        return
+    if WRITE_BEHIND:
+        # Acknowledge now, the flusher upserts in bulk
+        enqueue_rows(rows)
+        return
+    try:
+        upsert_rows(rows)
+    except Exception:
+        # Not written after all: the retry must not be suppressed
+        forget_heartbeats([row["username"] for row in rows])
+        raise
+
+def forget_heartbeats(usernames=None):
+    """Forget what was persisted for deleted users, so their next heartbeat is written again."""
+    with _seen_lock:
+        if usernames is None:
+            _persisted.clear()
+            _seen.clear()
+        for username in usernames or ():
+            _persisted.pop(username, None)
+            _seen.pop(username, None)
+        _seen_state['version'] += 1
+
+def _forget_deleted():
+    # Deletions handled by other workers reach us through the tombstone log
+    start, entries = load_tombstones()
+    if _tombstones['key'] == _seen_state['tombstone_key']:
+        return
+    _seen_state['tombstone_key'] = _tombstones['key']
+
+    since = _seen_state['tombstone_t']
+    recent = [e for e in entries if e["t"] >= since]
+    if any(e.get("reset") for e in recent):
+        forget_heartbeats()
+    else:
+        forget_heartbeats([e["u"] for e in recent if "u" in e])
+    if entries:
+        _seen_state['tombstone_t'] = entries[-1]["t"]
+
+def publish_seen():
+    path = f"{SEEN_PATH}.{os.getpid()}.json"
+    cutoff = int(time.time() * 1000) - TIMEOUT * 2000
+    with _seen_lock:
+        for username in [u for u, ts in _seen.items() if ts < cutoff]:
+            del _seen[username]
+        seen = dict(_seen)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(seen, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def _seen_loop():
+    published = None
+    while True:
+        time.sleep(SEEN_PUBLISH_INTERVAL)
+        # Unchanged maps are republished now and then so readers don't take the file for a dead worker's
+        version = _seen_state['version']
+        if version == published and int(time.time()) % TIMEOUT:
+            continue
+        try:
+            publish_seen()
+            published = version
+        except OSError as e:
+            print(f"[ERROR] publish_seen: {str(e)}")
+
+def _ensure_seen_writer():
+    if _seen_state['pid'] == os.getpid() and _seen_state['thread'].is_alive():
+        return
+    with _seen_lock:
+        if _seen_state['pid'] == os.getpid() and _seen_state['thread'].is_alive():
+            return
+        thread = threading.Thread(target=_seen_loop, name="last-seen", daemon=True)
+        thread.start()
+        _seen_state['thread'] = thread
+        _seen_state['pid'] = os.getpid()
+
+def seen_map():
+    """
+    username -> latest heartbeat not yet in Supabase, from every worker on
+    this host (others' maps are up to SEEN_PUBLISH_INTERVAL old). Rebuilt
+    at most twice per interval.
+    """
+    now = time.time()
+    if now - _seen_state['merged_at'] < SEEN_PUBLISH_INTERVAL / 2:
+        return _seen_state['merged']
+
+    own = f"{SEEN_PATH}.{os.getpid()}.json"
+    files = {}
+    for path in glob.glob(f"{SEEN_PATH}.*.json"):
+        if path == own:
+            continue
+        try:
+            st = os.stat(path)
+            if now - st.st_mtime > TIMEOUT * 2:
+                # Probably an exited worker's: its entries are stale by now, so drop the file
+                pid = _file_pid(path, SEEN_PATH)
+                if pid is not None and not _pid_alive(pid):
+                    os.remove(path)
+                continue
+            key = (st.st_ino, st.st_mtime_ns, st.st_size)
+            cached = _seen_state['files'].get(path)
+            if cached is None or cached[0] != key:
+                with open(path) as f:
+                    cached = (key, json.load(f))
+        except (FileNotFoundError, ValueError):
+            continue
+        files[path] = cached
+
+    with _seen_lock:
+        merged = dict(_seen)
+    for _, seen in files.values():
+        for username, ts in seen.items():
+            if ts > merged.get(username, 0):
+                merged[username] = ts
+
+    _seen_state.update(files=files, merged=merged, merged_at=now)
+    return merged
+
+def _flush_loop():
+    while True:
+        _flush_event.wait(FLUSH_INTERVAL)
+        _flush_event.clear()
+        flush_write_buffer()
+
+def _ensure_flusher():
+    # Threads don't survive a fork, so each gunicorn worker starts its own
+    if _flusher['pid'] == os.getpid() and _flusher['thread'].is_alive():
+        return
+    with _write_lock:
+        if _flusher['pid'] == os.getpid() and _flusher['thread'].is_alive():
+            return
+        thread = threading.Thread(target=_flush_loop, name="write-behind", daemon=True)
+        thread.start()
+        _flusher['thread'] = thread
+        _flusher['pid'] = os.getpid()
+
+# Flush whatever is still pending when the process exits cleanly
+atexit.register(flush_write_buffer)
+
+# Deletion log shared by all workers on this host (one JSON object per line).
+# The first line marks when the log started; cursors older than that, or older
+# than TOMBSTONE_RETENTION, get a full reset instead of a delta.
+_tombstones = {'key': None, 'start': 0, 'entries': []}
+_tombstone_lock = threading.Lock()
+
+def _open_tombstone_lock():
+    lock_file = open(TOMBSTONE_PATH + ".lock", "a")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+def record_tombstones(usernames=None, reset=False):
+    """Log deleted usernames (or a full reset) for delta clients."""
+    now_ms = int(time.time() * 1000)
+    if reset:
+        lines = [{"t": now_ms, "reset": True}]
+    else:
+        lines = [{"t": now_ms, "u": username} for username in usernames]
+    if not lines and os.path.exists(TOMBSTONE_PATH):
+        return
+
+    lock_file = _open_tombstone_lock()
+    try:
+        if not os.path.exists(TOMBSTONE_PATH) or os.path.getsize(TOMBSTONE_PATH) > 256 * 1024:
+            # Start (or compact) the log, keeping entries still inside the retention window
+            horizon = now_ms - TOMBSTONE_RETENTION * 1000
+            start, entries = _read_tombstone_file()
+            kept = [e for e in entries if e["t"] >= horizon]
+            start = max(start, horizon) if start else now_ms
+            tmp_path = TOMBSTONE_PATH + ".tmp"
+            with open(tmp_path, "w") as f:
+                for entry in [{"t": start, "start": True}] + kept:
+                    f.write(json.dumps(entry, separators=(',', ':')) + "\n")
+            os.replace(tmp_path, TOMBSTONE_PATH)
+
+        if lines:
+            with open(TOMBSTONE_PATH, "a") as f:
+                f.write("".join(json.dumps(entry, separators=(',', ':')) + "\n" for entry in lines))
+    finally:
+        lock_file.close()
+
+def _read_tombstone_file():
+    start, entries = 0, []
+    try:
+        with open(TOMBSTONE_PATH) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # torn write
+                if entry.get("start"):
+                    start = entry["t"]
+                else:
+                    entries.append(entry)
+    except FileNotFoundError:
+        pass
+    return start, entries
+
+def load_tombstones():
+    """Return (log start ms, entries), re-reading the file only when it changed."""
+    try:
+        st = os.stat(TOMBSTONE_PATH)
+    except FileNotFoundError:
+        return 0, []
+
+    key = (st.st_ino, st.st_size, st.st_mtime_ns)
+    with _tombstone_lock:
+        if _tombstones['key'] != key:
+            _tombstones['start'], _tombstones['entries'] = _read_tombstone_file()
+            _tombstones['key'] = key
+        return _tombstones['start'], _tombstones['entries']
+
+def format_user(user, now_ms, seen=None):
+    timestamp = user["timestamp"]
+    if seen:
+        # Heartbeats that weren't written still count as activity
+        timestamp = min(max(timestamp, seen.get(user["username"], 0)), now_ms)
+    time_diff = (now_ms - timestamp) / 1000  # convert to seconds
+    status = "ONLINE" if time_diff <= TIMEOUT else "OFFLINE"
+
+    return {
+        "username": user["username"],
+        "diamonds": user["diamonds"],
+        "diamonds_total": row_diamonds_total(user),
+        "device": user["device"],
+        "status": status,
+        "last_seen": int(time_diff)
+    }
+
+# Diamond history: one ring per user, so memory is bounded by
+# HISTORY_MAX_USERS * HISTORY_POINTS no matter how often devices report
+HISTORY_INITIAL_POINTS = 8  # rings start this small and double up to HISTORY_POINTS
+
+class HistoryRing:
+    """(second, diamonds total) samples, at most one per HISTORY_RESOLUTION slot."""
+    __slots__ = ("times", "totals", "start", "size")
+
+    def __init__(self):
+        capacity = min(HISTORY_INITIAL_POINTS, HISTORY_POINTS)
+        self.times = array("I", [0]) * capacity
+        self.totals = array("q", [0]) * capacity
+        self.start = 0
+        self.size = 0
+
+    def _grow(self):
+        # Unrolled oldest first, so start goes back to 0
+        order = [(self.start + i) % len(self.times) for i in range(self.size)]
+        padding = min(len(self.times) * 2, HISTORY_POINTS) - self.size
+        self.times = array("I", [self.times[i] for i in order]) + array("I", [0]) * padding
+        self.totals = array("q", [self.totals[i] for i in order]) + array("q", [0]) * padding
+        self.start = 0
+
+    def add(self, second, total):
+        capacity = len(self.times)
+        if self.size:
+            last = (self.start + self.size - 1) % capacity
+            if second < self.times[last]:
+                return  # out of order (e.g. a row synced from another worker)
+            if second // HISTORY_RESOLUTION == self.times[last] // HISTORY_RESOLUTION:
+                # Same slot: the latest sample wins
+                self.times[last] = second
+                self.totals[last] = total
+                return
+
+        if self.size == capacity < HISTORY_POINTS:
+            self._grow()
+            capacity = len(self.times)
+        if self.size < capacity:
+            slot = (self.start + self.size) % capacity
+            self.size += 1
+        else:
+            slot = self.start
+            self.start = (self.start + 1) % capacity
+        self.times[slot] = second
+        self.totals[slot] = total
+
+    def samples(self, start, end):
+        """Samples with start <= second < end, oldest first."""
+        for i in range(self.size):
+            slot = (self.start + i) % len(self.times)
+            if start <= self.times[slot] < end:
+                yield self.times[slot], self.totals[slot]
+
+_history = OrderedDict()  # username -> HistoryRing, least recently updated first
+_history_lock = threading.Lock()
+
+def record_history(rows):
+    """Best effort: a sample that can't be stored is logged and skipped, never failing ingest."""
+    with _history_lock:
+        for row in rows:
+            try:
+                username = row["username"]
+                ring = _history.get(username)
+                if ring is None:
+                    if len(_history) >= HISTORY_MAX_USERS:
+                        _history.popitem(last=False)
+                    ring = _history[username] = HistoryRing()
+                else:
+                    _history.move_to_end(username)
+                ring.add(row["timestamp"] // 1000, _clamp_count(row_diamonds_total(row)))
+            except Exception as e:
+                print(f"[ERROR] record_history: {str(e)}")
+
+def forget_history(usernames=None):
+    with _history_lock:
+        if usernames is None:
+            _history.clear()
+        for username in usernames or ():
+            _history.pop(username, None)
+
+def downsample_history(username, start_ms, end_ms, step_ms):
+    """
+    min/max/last diamonds total per step-wide bucket between start_ms and
+    end_ms (inclusive), as parallel arrays keyed by bucket start. Buckets
+    are aligned to multiples of step; empty ones are left out. None for
+    unknown users.
+    """
+    buckets = {}
+    with _history_lock:
+        ring = _history.get(username)
+        if ring is None:
+            return None
+        for second, total in ring.samples(start_ms // 1000, end_ms // 1000 + 1):
+            t = second * 1000
+            if not start_ms <= t <= end_ms:
+                continue
+            bucket = t // step_ms * step_ms
+            if bucket in buckets:
+                low, high, _ = buckets[bucket]
+                buckets[bucket] = (min(low, total), max(high, total), total)
+            else:
+                buckets[bucket] = (total, total, total)
+
+    return {
+        "t": list(buckets),
+        "min": [b[0] for b in buckets.values()],
+        "max": [b[1] for b in buckets.values()],
+        "last": [b[2] for b in buckets.values()]
+    }
+
+@app.route("/")
+def index():
+    asset = _index_assets[MAX_STREAM_CLIENTS > 0]
+    return encoded_response(asset["body"], asset["etag"], asset["mimetype"], lambda: asset["gzip"])
+
+@app.route("/app.js")
+def app_js():
+    # The page links this with ?v=<etag>, so it can be cached for good
+    asset = _app_asset
+    return encoded_response(
+        asset["body"], asset["etag"], asset["mimetype"], lambda: asset["gzip"],
+        cache_control="public, max-age=31536000, immutable"
+    )
+
+@app.route("/send_data", methods=["POST"])
+def receive_data():
+    try:
+        data = request.json
+        if not data:
+            return jsonify({"status": "error", "message": "No JSON received"}), 400
+
+        row = build_user_row(data)
+        record_history([row])
+        inc("ingested_rows_total", route="/send_data")
+
+        store_rows([row])
+        notify_changes([row])
+
+        return jsonify({"status": "success"}), 200
+    except Exception as e:
+        print(f"[ERROR] {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+class BatchError(ValueError):
+    """A /send_batch request refused as a whole."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def decode_batch(body, encoding=""):
+    """
+    Decode a /send_batch body into a list of records.
+    Accepts a JSON array or newline-delimited JSON, optionally gzip-encoded.
+    """
+    try:
+        if encoding.lower() == "gzip" or body[:2] == b"\x1f\x8b":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            body = decompressor.decompress(body, MAX_BATCH_BYTES + 1)
+            if len(body) > MAX_BATCH_BYTES or decompressor.unconsumed_tail:
+                raise ValueError(f"Decoded body exceeds {MAX_BATCH_BYTES} bytes")
+        elif len(body) > MAX_BATCH_BYTES:
+            raise ValueError(f"Body exceeds {MAX_BATCH_BYTES} bytes")
+
+        text = body.decode("utf-8").strip()
+        if not text:
+            return []
+
+        if text.startswith("["):
+            return json.loads(text)
+
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    except (ValueError, OSError, zlib.error) as e:
+        raise BatchError(f"Invalid batch body: {str(e)}")
+
+def build_batch_rows(records):
+    """Validate decoded records. Returns (rows keyed by username, rejected records)."""
+    if not isinstance(records, list):
+        raise BatchError("Expected a JSON array or NDJSON")
+    if not records:
+        raise BatchError("No records received")
+    if len(records) > MAX_BATCH_RECORDS:
+        raise BatchError(f"Too many records (max {MAX_BATCH_RECORDS})", 413)
+
+    timestamp = int(time.time() * 1000)
+    rows = {}
+    rejected = []
+
+    for index, data in enumerate(records):
+        if not isinstance(data, dict) or not data.get("username"):
+            rejected.append({"index": index, "message": "Record must be an object with a username"})
+            continue
+        # Same username twice in one batch: the later record wins
+        row = build_user_row(data, timestamp)
+        rows[row["username"]] = row
+
+    return rows, rejected
+
+@app.route("/send_batch", methods=["POST"])
+def receive_batch():
+    try:
+        try:
+            records = decode_batch(request.get_data(), request.headers.get("Content-Encoding", ""))
+            rows, rejected = build_batch_rows(records)
+        except BatchError as e:
+            return jsonify({"status": "error", "message": str(e)}), e.status
+
+        if rows:
+            record_history(rows.values())
+            inc("ingested_rows_total", len(rows), route="/send_batch")
+            store_rows(rows.values())
+            notify_changes(rows.values())
+
+        return jsonify({
+            "status": "success",
+            "accepted": len(rows),
+            "rejected": rejected
+        }), 200
+    except Exception as e:
+        print(f"[ERROR] receive_batch: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route("/get_data", methods=["GET"])
+def get_data():
+    since = request.args.get("since", type=int)
+    if since is not None:
+        return get_data_delta(since)
+
+    mode = snapshot_mode(request.args)
+    if mode is None:
+        return get_data_page()
+
+    fmt = response_format()
+    try:
+        body, etag = snapshot_body(time.time(), fmt, mode)
+    except Exception as e:
+        print(f"[ERROR] get_data: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+    return encoded_response(
+        body, etag, COLUMNAR_MIMETYPE if fmt == "columnar" else "application/json",
+        lambda: snapshot_gzip(body, fmt, mode)
+    )
+
+def snapshot_mode(args):
+    """
+    The snapshot a /get_data query is served from, or None when it needs
+    the paged live index. ?status=online on its own is a snapshot too.
+    """
+    paging = [arg for arg in PAGE_ARGS if arg in args]
+    if not paging:
+        return "all"
+    if paging == ["status"] and args["status"] == "online":
+        return "online"
+    return None
+
+def response_format():
+    """ "columnar" when asked for via ?format=columnar or the Accept header, else "json"."""
+    if request.args.get("format") == "columnar" or COLUMNAR_MIMETYPE in request.headers.get("Accept", ""):
+        return "columnar"
+    return "json"
+
+def encode_columnar(users):
+    """
+    Columnar form of formatted users: one array per field, with device and
+    status stored as indexes into "dictionaries".
+    """
+    devices = {}
+    statuses = {"ONLINE": 0, "OFFLINE": 1}
+
+    return {
+        "format": "columnar",
+        "count": len(users),
+        "columns": {
+            "username": [user["username"] for user in users],
+            "diamonds": [user["diamonds"] for user in users],
+            "diamonds_total": [user["diamonds_total"] for user in users],
+            "device": [devices.setdefault(user["device"], len(devices)) for user in users],
+            "status": [statuses[user["status"]] for user in users],
+            "last_seen": [user["last_seen"] for user in users]
+        },
+        "dictionaries": {
+            "device": list(devices),
+            "status": list(statuses)
+        }
+    }
+
+def snapshot_body(now, fmt="json", mode="all"):
+    """JSON body and ETag of the current snapshot in the given format."""
+    return encode_snapshot(load_snapshot(now, mode), now, fmt, mode)
+
+def encode_snapshot(rows, now, fmt="json", mode="all"):
+    """
+    Rows are formatted relative to the snapshot's fetch time, so each
+    snapshot is encoded once per format and the ETag is the same on every
+    worker.
+    """
+    cache = _caches[mode]
+    with _cache_lock:
+        if cache['rows'] is rows and fmt in cache['encoded']:
+            encoded = cache['encoded'][fmt]
+            return encoded['body'], encoded['etag']
+        header = cache['header'] if cache['rows'] is rows else None
+
+    fetched_at = header["fetched_at"] if header else now
+    now_ms = int(fetched_at * 1000)
+    seen = seen_map()
+    result = [format_user(user, now_ms, seen) for user in rows]
+    if mode == "online":
+        # Supabase's filter is a superset (see snapshot_query)
+        result = [user for user in result if user["status"] == "ONLINE"]
+    if fmt == "columnar":
+        result = encode_columnar(result)
+    body = json.dumps(result, separators=(',', ':')).encode()
+    etag = f"{fmt}-{hashlib.blake2b(body, digest_size=12).hexdigest()}"
+
+    # Update cache
+    with _cache_lock:
+        if cache['rows'] is rows:
+            cache['encoded'][fmt] = {'body': body, 'etag': etag, 'gzip': None}
+
+    return body, etag
+
+def snapshot_gzip(body, fmt="json", mode="all"):
+    """Gzip variant of a snapshot body, compressed once per snapshot and format."""
+    cache = _caches[mode]
+    with _cache_lock:
+        encoded = cache['encoded'].get(fmt)
+        if encoded and encoded['body'] is body and encoded['gzip'] is not None:
+            return encoded['gzip']
+
+    compressed = gzip.compress(body, compresslevel=6)
+    with _cache_lock:
+        encoded = cache['encoded'].get(fmt)
+        if encoded and encoded['body'] is body:
+            encoded['gzip'] = compressed
+    return compressed
+
+def delta_window(since, now):
+    """
+    Whether a cursor needs a full reset, plus the tombstone entries to
+    pick deletions from. Returns (reset, entries).
+    """
+    now_ms = int(now * 1000)
+
+    start, entries = load_tombstones()
+    if not start:
+        # No log yet: start one so the next cursor can be served as a delta
+        record_tombstones([])
+        start, entries = now_ms, []
+
+    horizon = max(start, now_ms - TOMBSTONE_RETENTION * 1000)
+    reset = since < horizon or any(e.get("reset") and e["t"] >= since for e in entries)
+    return reset, entries
+
+def deleted_since(entries, since, rows):
+    changed = {user["username"] for user in rows}
+    return sorted({
+        e["u"] for e in entries
+        if "u" in e and e["t"] >= since - DELTA_OVERLAP_MS and e["u"] not in changed
+    })
+
+def fetch_changes(since, now):
+    """
+    Raw rows changed since the cursor and usernames deleted since then.
+    Returns (reset, rows, deleted, cursor); reset=True means rows is the
+    full table. The cursor is where the next call should pick up.
+    """
+    reset, entries = delta_window(since, now)
+    if reset:
+        # Never a stale snapshot: whatever it misses would not be in later deltas either
+        rows = load_snapshot(now, allow_stale=False)
+        return True, rows, [], reset_cursor(rows, now)
+
+    # Served by idx_timestamp
+    response = run_query("changes", supabase.table(TABLE_NAME).select(SNAPSHOT_COLUMNS).gte("timestamp", since - DELTA_OVERLAP_MS))
+    return False, response.data, deleted_since(entries, since, response.data), int(now * 1000)
+
+def reset_cursor(rows, now):
+    # Changes and deletions after the snapshot's fetch must still show up in the next delta
+    fetched_at = snapshot_fetched_at(rows)
+    return int(min(fetched_at or now, now) * 1000)
+
+def build_delta(now, since, reset, rows, deleted, cursor):
+    """
+    Besides changed users, "seen" maps users who only sent unchanged
+    heartbeats since the cursor to their last_seen.
+    """
+    now_ms = int(now * 1000)
+    seen = seen_map()
+    delta = {
+        "cursor": cursor,
+        "reset": reset,
+        "users": [format_user(user, now_ms, seen) for user in rows],
+        "deleted": deleted,
+        "seen": {}
+    }
+    if not reset:
+        changed = {user["username"] for user in rows}
+        delta["seen"] = {
+            username: max(int((now_ms - ts) / 1000), 0) for username, ts in seen.items()
+            if ts >= since - DELTA_OVERLAP_MS and username not in changed
+        }
+    return delta
+
+def compute_delta(since):
+    """
+    Rows changed since the cursor plus deletions, as
+    {"cursor", "reset", "users", "deleted", "seen"}. Clients pass the
+    returned cursor back; reset=true means "replace everything with users".
+    """
+    now = time.time()
+    return build_delta(now, since, *fetch_changes(since, now))
+
+def get_data_delta(since):
+    try:
+        delta = compute_delta(since)
+        if response_format() == "columnar":
+            delta["users"] = encode_columnar(delta["users"])
+        return jsonify(delta)
+    except Exception as e:
+        print(f"[ERROR] get_data_delta: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# Live state: one loop per worker merges local writes with a delta sync from
+# Supabase (for writes handled by other workers), keeps per-user presence and
+# running aggregates, tracks ONLINE -> OFFLINE transitions and fans the result
+# out to every /stream subscriber. It runs while someone streams or reads /stats.
+_subscribers = set()
+_stream_lock = threading.Lock()
+_stream_ready = threading.Event()
+_stream = {
+    'thread': None, 'pid': None, 'last_read': 0,
+    'users': {}, 'deleted': set(), 'reset': False
+}
+_live_lock = threading.RLock()  # guards the structures below against readers
+_presence = {}  # username -> (last heartbeat ms, diamonds total, device)
+_live_rows = {}  # username -> latest row
+_online = set()
+# Expiry wheel: online users bucketed by the slot in which they go offline, so
+# each tick only looks at the slots that just passed instead of every online user
+_EXPIRY_SLOT_MS = max(int(STREAM_PUSH_INTERVAL * 1000), 1)
+_expiry = {}  # slot -> usernames going offline in it
+_expiry_slot = {}  # username -> its slot in _expiry
+_wheel = {'slot': 0}  # last slot expired
+_transitions = {'online': [], 'offline': []}  # since the listeners were last called
+_status_listeners = []
+_totals = {'users': 0, 'online': 0, 'diamonds': 0, 'gained': 0}
+_devices = {}  # device -> {"total", "online", "diamonds"}
+_stats = {'snapshot': None, 'rate': 0.0}
+
+def format_event(event, data, event_id=None):
+    message = f"event: {event}\n"
+    if event_id is not None:
+        message += f"id: {event_id}\n"
+    return message + f"data: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+def notify_changes(rows=(), deleted=(), reset=False):
+    """Hand local writes to the live loop so subscribers and stats see them right away."""
+    if _stream['thread'] is None or _stream['pid'] != os.getpid():
+        return
+    with _stream_lock:
+        if reset:
+            _stream['users'].clear()
+            _stream['deleted'].clear()
+            _stream['reset'] = True
+        for row in rows:
+            _stream['users'][row["username"]] = row
+            _stream['deleted'].discard(row["username"])
+        for username in deleted:
+            _stream['users'].pop(username, None)
+            _stream['deleted'].add(username)
+
+def on_status_change(listener):
+    """
+    Register listener(online, offline, now_ms), called by the live loop with
+    the users that turned ONLINE / OFFLINE since its last tick. Each
+    transition is reported once; users appearing or being deleted aren't
+    transitions.
+    """
+    _status_listeners.append(listener)
+    return listener
+
+def publish_event(event, data, event_id=None):
+    message = format_event(event, data, event_id)
+    with _stream_lock:
+        subscribers = list(_subscribers)
+
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(message)
+        except queue.Full:
+            # Too slow to keep up: drop it, the browser reconnects and resyncs
+            with _stream_lock:
+                _subscribers.discard(subscriber)
+
+# Sorted indexes for paged /get_data, kept in step with _presence.
+# Ascending order of each key is the natural ascending order of that column
+# (for last_seen: most recently seen first).
+_SORT_KEYS = {
+    "diamonds": lambda username, entry: (entry[1], username),
+    "username": lambda username, entry: (username,),
+    "device": lambda username, entry: (entry[2], username),
+    "last_seen": lambda username, entry: (-entry[0], username)
+}
+_DEFAULT_ORDER = {"diamonds": "desc", "username": "asc", "device": "asc", "last_seen": "asc"}
+_indexes = {sort: [] for sort in _SORT_KEYS}
+
+def _apply_row(row, now_ms):
+    # O(1): swap the user's old contribution to the aggregates for the new one
+    username = row["username"]
+    diamonds = row_diamonds_total(row)
+    device = row["device"] or "Unknown"
+
+    previous = _presence.get(username)
+    was_online = username in _online
+    if previous is not None:
+        _totals['gained'] += max(diamonds - previous[1], 0)
+        _drop_user(username)
+
+    entry = (row["timestamp"], diamonds, device)
+    _presence[username] = entry
+    record_history([row])  # picks up heartbeats other workers received
+    _live_rows[username] = row
+    for sort, key in _SORT_KEYS.items():
+        bisect.insort(_indexes[sort], key(username, entry))
+
+    device_stats = _devices.setdefault(device, {"total": 0, "online": 0, "diamonds": 0})
+    device_stats["total"] += 1
+    device_stats["diamonds"] += diamonds
+    _totals['users'] += 1
+    _totals['diamonds'] += diamonds
+
+    if now_ms - row["timestamp"] <= TIMEOUT * 1000:
+        _online.add(username)
+        device_stats["online"] += 1
+        _totals['online'] += 1
+        # First slot that starts after the user's last online moment
+        slot = (row["timestamp"] + TIMEOUT * 1000) // _EXPIRY_SLOT_MS + 1
+        _expiry.setdefault(slot, set()).add(username)
+        _expiry_slot[username] = slot
+        if previous is not None and not was_online:
+            _transitions['online'].append(username)
+    elif was_online:
+        # Replaced by a row that is already stale
+        _transitions['offline'].append(username)
+
+def _drop_user(username):
+    entry = _presence.pop(username, None)
+    if entry is None:
+        return
+    _, diamonds, device = entry
+    del _live_rows[username]
+    for sort, key in _SORT_KEYS.items():
+        index = _indexes[sort]
+        del index[bisect.bisect_left(index, key(username, entry))]
+
+    device_stats = _devices[device]
+    device_stats["total"] -= 1
+    device_stats["diamonds"] -= diamonds
+    _totals['users'] -= 1
+    _totals['diamonds'] -= diamonds
+
+    if username in _online:
+        _online.discard(username)
+        _unschedule(username)
+        device_stats["online"] -= 1
+        _totals['online'] -= 1
+    if device_stats["total"] == 0:
+        del _devices[device]
+
+def _unschedule(username):
+    slot = _expiry_slot.pop(username)
+    users = _expiry[slot]
+    users.discard(username)
+    if not users:
+        del _expiry[slot]
+
+def _mark_offline(username):
+    _online.discard(username)
+    _devices[_presence[username][2]]["online"] -= 1
+    _totals['online'] -= 1
+    _transitions['offline'].append(username)
+
+def expire_due(now_ms):
+    """Take users whose expiry slot has passed offline; work is proportional to them, not to _online."""
+    last = now_ms // _EXPIRY_SLOT_MS  # everyone in a slot that has begun is past TIMEOUT
+    first = _wheel['slot'] + 1
+    if last - first > len(_expiry):
+        # Idle for a long time: cheaper to look at the occupied slots
+        due = sorted(slot for slot in _expiry if slot <= last)
+    else:
+        due = range(first, last + 1)
+    for slot in due:
+        for username in _expiry.pop(slot, ()):
+            del _expiry_slot[username]
+            _mark_offline(username)
+    _wheel['slot'] = max(last, _wheel['slot'])
+
+def _clear_live():
+    _presence.clear()
+    _live_rows.clear()
+    for index in _indexes.values():
+        index.clear()
+    _online.clear()
+    _expiry.clear()
+    _expiry_slot.clear()
+    _wheel['slot'] = int(time.time() * 1000) // _EXPIRY_SLOT_MS
+    _devices.clear()
+    _totals.update(users=0, online=0, diamonds=0, gained=0)
+
+def _stream_loop():
+    cursor = None
+    next_sync = 0
+    last_tick = time.time()
+    _clear_live()
+    _stats['rate'] = 0.0
+
+    while True:
+        time.sleep(STREAM_PUSH_INTERVAL)
+        now = time.time()
+        now_ms = int(now * 1000)
+
+        with _stream_lock:
+            if not _subscribers and now - _stream['last_read'] > LIVE_IDLE_TIMEOUT:
+                _stream['thread'] = None
+                _stream_ready.clear()
+                return
+            rows, deleted, reset = _stream['users'], _stream['deleted'], _stream['reset']
+            _stream['users'], _stream['deleted'], _stream['reset'] = {}, set(), False
+
+        if cursor is None:
+            # Learn the current table; subscribers got their own snapshot on connect
+            try:
+                _, seed_rows, _, seed_cursor = fetch_changes(0, now)
+                with _live_lock:
+                    for row in seed_rows:
+                        _apply_row(row, now_ms)
+                    _totals['gained'] = 0
+                    _transitions.update(online=[], offline=[])
+                cursor = seed_cursor
+                next_sync = now + STREAM_SYNC_INTERVAL
+            except Exception as e:
+                print(f"[ERROR] stream seed: {str(e)}")
+
+        if cursor is not None and now >= next_sync:
+            next_sync = now + STREAM_SYNC_INTERVAL
+            try:
+                sync_reset, sync_rows, sync_deleted, cursor = fetch_changes(cursor, now)
+                if sync_reset:
+                    reset = True
+                    deleted = set()
+                for row in sync_rows:
+                    local = rows.get(row["username"])
+                    if local is None or local["timestamp"] < row["timestamp"]:
+                        rows[row["username"]] = row
+                deleted.update(u for u in sync_deleted if u not in rows and u in _presence)
+                # Unchanged heartbeats other workers didn't write
+                for username, ts in seen_map().items():
+                    if username not in rows and username in _presence and ts > _presence[username][0]:
+                        rows[username] = dict(_live_rows[username], timestamp=ts)
+            except Exception as e:
+                print(f"[ERROR] stream sync: {str(e)}")
+
+        with _live_lock:
+            if reset:
+                _clear_live()
+                _transitions.update(online=[], offline=[])
+            else:
+                # Skip rows subscribers already got (the sync window overlaps)
+                rows = {
+                    u: row for u, row in rows.items()
+                    if u not in _presence or row["timestamp"] > _presence[u][0]
+                }
+
+            for row in rows.values():
+                _apply_row(row, now_ms)
+            for username in deleted:
+                _drop_user(username)
+
+            expire_due(now_ms)
+            went_online, went_offline = _transitions['online'], _transitions['offline']
+            _transitions.update(online=[], offline=[])
+
+        # Exponentially smoothed diamonds/sec over STATS_RATE_WINDOW
+        elapsed = max(now - last_tick, 1e-3)
+        alpha = 1 - math.exp(-elapsed / STATS_RATE_WINDOW)
+        _stats['rate'] += alpha * (_totals['gained'] / elapsed - _stats['rate'])
+        _totals['gained'] = 0
+        last_tick = now
+
+        if cursor is not None:
+            snapshot = {
+                "total": _totals['users'],
+                "online": _totals['online'],
+                "offline": _totals['users'] - _totals['online'],
+                "diamonds": _totals['diamonds'],
+                "diamonds_per_second": round(_stats['rate'], 2),
+                "devices": {device: dict(data) for device, data in _devices.items()}
+            }
+            changed = snapshot != _stats['snapshot']
+            _stats['snapshot'] = snapshot
+            _stream_ready.set()
+        else:
+            changed = False
+
+        if reset or rows or deleted:
+            publish_event("delta", {
+                "cursor": cursor,
+                "reset": reset,
+                "users": [format_user(row, now_ms) for row in rows.values()],
+                "deleted": sorted(deleted)
+            }, cursor)
+        if went_online or went_offline:
+            for listener in _status_listeners:
+                try:
+                    listener(went_online, went_offline, now_ms)
+                except Exception as e:
+                    print(f"[ERROR] status listener: {str(e)}")
+        if changed:
+            publish_event("stats", _stats['snapshot'])
+
+@on_status_change
+def publish_status(online, offline, now_ms):
+    # Users coming back online also arrive in the delta; this spares clients a diff
+    publish_event("status", {"online": sorted(online), "offline": sorted(offline)})
+
+def _ensure_stream_loop():
+    with _stream_lock:
+        if _stream['pid'] == os.getpid() and _stream['thread'] and _stream['thread'].is_alive():
+            return
+        _stream_ready.clear()
+        thread = threading.Thread(target=_stream_loop, name="stream", daemon=True)
+        thread.start()
+        _stream['thread'] = thread
+        _stream['pid'] = os.getpid()
+
+@app.route("/stream", methods=["GET"])
+def stream():
+    """
+    Server-Sent Events: a "delta" snapshot on connect, then "delta" events
+    (same shape as /get_data?since=) and "status" events listing users
+    that went online/offline. Needs a threaded worker class with spare
+    threads, e.g. gunicorn -k gthread --threads 32 and WORKER_THREADS=32.
+    """
+    if MAX_STREAM_CLIENTS <= 0:
+        return jsonify({"status": "error", "message": "Streaming is disabled on this server"}), 503
+
+    since = request.headers.get("Last-Event-ID", 0, type=int)
+    subscriber = queue.Queue(maxsize=256)
+
+    with _stream_lock:
+        if len(_subscribers) >= MAX_STREAM_CLIENTS:
+            return jsonify({"status": "error", "message": "Too many stream clients"}), 503
+        _subscribers.add(subscriber)
+    _ensure_stream_loop()
+
+    try:
+        snapshot = compute_delta(since)
+    except Exception as e:
+        with _stream_lock:
+            _subscribers.discard(subscriber)
+        print(f"[ERROR] stream: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+    def generate():
+        try:
+            yield "retry: 3000\n" + format_event("delta", snapshot, snapshot["cursor"])
+            if _stats['snapshot']:
+                yield format_event("stats", _stats['snapshot'])
+            while True:
+                try:
+                    message = subscriber.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    message = ": keepalive\n\n"
+                if subscriber not in _subscribers:
+                    return
+                yield message
+        finally:
+            with _stream_lock:
+                _subscribers.discard(subscriber)
+
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    """
+    Totals, per-device counts and a smoothed diamonds/sec rate, kept
+    incrementally by the live loop (also pushed as "stats" on /stream).
+    """
+    _stream['last_read'] = time.time()
+    _ensure_stream_loop()
+
+    if not _stream_ready.wait(5):
+        return jsonify({"status": "error", "message": "Stats not ready yet"}), 503
+    return jsonify(_stats['snapshot'])
+
+@app.route("/history", methods=["GET"])
+def get_history():
+    """
+    /history?username=&from=&to=&step= (milliseconds): a user's diamonds
+    total downsampled to min/max/last per step. Defaults to everything
+    kept, in up to 120 buckets.
+
+    History lives in each worker's memory: points from before this worker
+    started, or from heartbeats the live loop hasn't synced yet, are
+    missing, so series can differ slightly between workers. Users that
+    exist but have no points here get an empty series, not a 404.
+    """
+    username = request.args.get("username")
+    if not username:
+        return jsonify({"status": "error", "message": "Username required"}), 400
+
+    now_ms = int(time.time() * 1000)
+    end = request.args.get("to", now_ms, type=int)
+    start = request.args.get("from", end - HISTORY_POINTS * HISTORY_RESOLUTION * 1000, type=int)
+    step = request.args.get("step", max(-(-(end - start) // 120), HISTORY_RESOLUTION * 1000), type=int)
+    if start >= end or step <= 0:
+        return jsonify({"status": "error", "message": "Need from < to and step > 0"}), 400
+    if (end - start) // step + 1 > HISTORY_MAX_BUCKETS:
+        return jsonify({"status": "error", "message": f"Too many buckets (max {HISTORY_MAX_BUCKETS})"}), 400
+
+    # Keeps the live loop syncing, which feeds in other workers' heartbeats
+    _stream['last_read'] = time.time()
+    _ensure_stream_loop()
+
+    points = downsample_history(username, start, end, step)
+    if points is None:
+        _stream_ready.wait(5)
+        with _live_lock:
+            known = username in _live_rows
+        if not known:
+            return jsonify({"status": "error", "message": "No history for this user"}), 404
+        points = {"t": [], "min": [], "max": [], "last": []}
+    return jsonify({"username": username, "from": start, "to": end, "step": step, **points})
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode()).decode()
+
+def _decode_cursor(cursor):
+    return tuple(json.loads(base64.urlsafe_b64decode(cursor.encode())))
+
+def query_page(sort="diamonds", order=None, limit=PAGE_DEFAULT_LIMIT, offset=0, cursor=None, device=None, status=None):
+    """
+    Walk the live sorted index for one page of users.
+    Returns (rows, total matching, next cursor or None).
+    """
+    descending = (order or _DEFAULT_ORDER[sort]) == "desc"
+    now_ms = int(time.time() * 1000)
+
+    with _live_lock:
+        index = _indexes[sort]
+        if cursor is None:
+            position = len(index) - 1 if descending else 0
+        elif descending:
+            position = bisect.bisect_left(index, cursor) - 1
+        else:
+            position = bisect.bisect_right(index, cursor)
+        step = -1 if descending else 1
+
+        rows = []
+        last_key = None
+        while 0 <= position < len(index) and len(rows) < limit:
+            key = index[position]
+            position += step
+            username = key[-1]
+            entry = _presence[username]
+            if device is not None and entry[2] != device:
+                continue
+            if status is not None and (username in _online) != (status == "online"):
+                continue
+            if offset:
+                offset -= 1
+                continue
+            rows.append(format_user(_live_rows[username], now_ms))
+            last_key = key
+
+        has_more = 0 <= position < len(index)
+
+        # Counts come from the running aggregates, not a scan
+        if device is not None:
+            device_stats = _devices.get(device, {"total": 0, "online": 0})
+            total, online = device_stats["total"], device_stats["online"]
+        else:
+            total, online = _totals['users'], _totals['online']
+        if status == "online":
+            total = online
+        elif status == "offline":
+            total -= online
+
+    next_cursor = _encode_cursor(last_key) if has_more and last_key is not None else None
+    return rows, total, next_cursor
+
+def get_data_page():
+    """
+    /get_data?limit=&offset=|cursor=&sort=&order=&device=&status=
+    served from the live index as {"users", "total", "next_cursor"}.
+    """
+    payload, status = page_payload(request.args, response_format())
+    return jsonify(payload), status
+
+def page_payload(args, fmt="json"):
+    """Validate paging args (any mapping of query strings) and query the live index. Returns (payload, status)."""
+    sort = args.get("sort", "diamonds")
+    order = args.get("order")
+    status = args.get("status")
+    if sort not in _SORT_KEYS:
+        return {"status": "error", "message": f"sort must be one of {', '.join(_SORT_KEYS)}"}, 400
+    if order not in (None, "asc", "desc"):
+        return {"status": "error", "message": "order must be asc or desc"}, 400
+    if status not in (None, "online", "offline"):
+        return {"status": "error", "message": "status must be online or offline"}, 400
+
+    try:
+        limit = min(max(int(args.get("limit", PAGE_DEFAULT_LIMIT)), 1), PAGE_MAX_LIMIT)
+        offset = max(int(args.get("offset", 0)), 0)
+    except ValueError:
+        return {"status": "error", "message": "limit and offset must be integers"}, 400
+    try:
+        cursor = args.get("cursor")
+        cursor = _decode_cursor(cursor) if cursor else None
+    except (ValueError, TypeError):
+        return {"status": "error", "message": "Invalid cursor"}, 400
+
+    _stream['last_read'] = time.time()
+    _ensure_stream_loop()
+    if not _stream_ready.wait(5):
+        return {"status": "error", "message": "Index not ready yet"}, 503
+
+    try:
+        rows, total, next_cursor = query_page(
+            sort, order, limit, offset, cursor, args.get("device"), status
+        )
+    except TypeError:
+        # A cursor minted for a different sort
+        return {"status": "error", "message": "Invalid cursor"}, 400
+    if fmt == "columnar":
+        rows = encode_columnar(rows)
+    return {"users": rows, "total": total, "next_cursor": next_cursor}, 200
+
+def forget_users(usernames=None):
+    """Bookkeeping after rows were deleted in Supabase; usernames=None means the whole table."""
+    if usernames is None:
+        record_tombstones(reset=True)
+        notify_changes(reset=True)
+    else:
+        record_tombstones(usernames)
+        notify_changes(deleted=usernames)
+    forget_history(usernames)
+    forget_heartbeats(usernames)
+
+    # Invalidate cache; stale copies would still show the deleted users
+    invalidate_snapshot(purge=True)
+
+@app.route("/delete_user", methods=["POST"])
+def delete_user():
+    try:
+        data = request.json
+        username = data.get("username")
+        
+        if not username:
+            return jsonify({"status": "error", "message": "Username required"}), 400
+        
+        # Delete from Supabase
+        discard_pending([username])
+        run_query("delete_user", supabase.table(TABLE_NAME).delete().eq("username", username))
+        forget_users([username])
+        
+        return jsonify({"status": "success"})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route("/delete_all", methods=["POST"])
+def delete_all():
+    try:
+        # Delete all records from Supabase
+        # Note: Supabase requires a filter, so we delete where timestamp > 0
+        discard_pending()
+        run_query("delete_all", supabase.table(TABLE_NAME).delete().gt("timestamp", 0))
+        forget_users()
+        
+        return jsonify({"status": "success"})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+def bulk_delete_criteria(data):
+    """
+    Validate a /delete_users body: {"usernames": [...]} and/or
+    {"filter": {"device", "offline_for" (seconds), "diamonds_below"}}.
+    Returns (usernames or None, filter); raises ValueError.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("No JSON received")
+    usernames = data.get("usernames")
+    criteria = data.get("filter") or {}
+
+    if usernames is not None:
+        if not isinstance(usernames, list) or not all(isinstance(u, str) and u for u in usernames):
+            raise ValueError("usernames must be a list of usernames")
+        usernames = list(dict.fromkeys(usernames))
+    if not isinstance(criteria, dict) or set(criteria) - {"device", "offline_for", "diamonds_below"}:
+        raise ValueError("filter accepts device, offline_for and diamonds_below")
+    for key in ("offline_for", "diamonds_below"):
+        if key in criteria and (isinstance(criteria[key], bool) or not isinstance(criteria[key], (int, float))):
+            raise ValueError(f"{key} must be a number")
+    # Anything shorter than OFFLINE_AFTER could hit users still shown online
+    if criteria.get("offline_for", OFFLINE_AFTER) < OFFLINE_AFTER:
+        raise ValueError(f"offline_for must be at least {OFFLINE_AFTER:g} seconds")
+    if not usernames and not criteria:
+        # An empty filter would match everyone: that's what /delete_all is for
+        raise ValueError("Usernames or a filter required")
+    return usernames, criteria
+
+def filtered(query, criteria, now_ms, legacy=False):
+    """
+    Apply a bulk delete filter to a query builder (sync or async client
+    alike). legacy=True matches rows with no diamonds_total instead of
+    comparing it; see legacy_below().
+    """
+    if "device" in criteria:
+        query = query.eq("device", criteria["device"])
+    if "offline_for" in criteria:
+        query = query.lt("timestamp", now_ms - int(criteria["offline_for"] * 1000))
+    if legacy:
+        query = query.is_("diamonds_total", "null")
+    elif "diamonds_below" in criteria:
+        query = query.lt("diamonds_total", criteria["diamonds_below"])
+    return query
+
+def legacy_below(rows, criteria):
+    """
+    Usernames of rows written before diamonds_total existed (NULL there,
+    which lt() never matches) whose parsed total is under diamonds_below.
+    """
+    return [row["username"] for row in rows if row_diamonds_total(row) < criteria["diamonds_below"]]
+
+@app.route("/delete_users", methods=["POST"])
+def delete_users():
+    """
+    Delete many users in one request, by username list, by filter, or by
+    both (a listed user is only deleted if it also matches the filter).
+    """
+    try:
+        try:
+            usernames, criteria = bulk_delete_criteria(request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+
+        now_ms = int(time.time() * 1000)
+        deleted = []
+        if usernames:
+            if not criteria:
+                discard_pending(usernames)
+            for i in range(0, len(usernames), BULK_DELETE_CHUNK):
+                chunk = usernames[i:i + BULK_DELETE_CHUNK]
+                query = filtered(supabase.table(TABLE_NAME).delete().in_("username", chunk), criteria, now_ms)
+                result = run_query("delete_users", query)
+                deleted.extend(user["username"] for user in result.data or [])
+        else:
+            result = run_query("delete_users", filtered(supabase.table(TABLE_NAME).delete(), criteria, now_ms))
+            deleted = [user["username"] for user in result.data or []]
+
+        if "diamonds_below" in criteria:
+            legacy = []
+            for chunk in [usernames[i:i + BULK_DELETE_CHUNK] for i in range(0, len(usernames), BULK_DELETE_CHUNK)] if usernames else [None]:
+                query = filtered(supabase.table(TABLE_NAME).select("username,diamonds"), criteria, now_ms, legacy=True)
+                if chunk is not None:
+                    query = query.in_("username", chunk)
+                legacy.extend(legacy_below(run_query("delete_users", query).data or [], criteria))
+            for i in range(0, len(legacy), BULK_DELETE_CHUNK):
+                query = filtered(supabase.table(TABLE_NAME).delete().in_("username", legacy[i:i + BULK_DELETE_CHUNK]), criteria, now_ms, legacy=True)
+                result = run_query("delete_users", query)
+                deleted.extend(user["username"] for user in result.data or [])
+
+        if deleted:
+            discard_pending(deleted)
+            forget_users(deleted)
+
+        return jsonify({"status": "success", "deleted": len(deleted), "message": f"Removed {len(deleted)} users"})
+    except Exception as e:
+        print(f"[ERROR] delete_users: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route("/cleanup_offline", methods=["POST"])
+def cleanup_offline():
+    try:
+        now_ms = int(time.time() * 1000)
+        cutoff = now_ms - int(OFFLINE_AFTER * 1000)
+        
+        # Delete offline users from Supabase
+        result = run_query("cleanup_offline", supabase.table(TABLE_NAME).delete().lt("timestamp", cutoff))
+        forget_users([user["username"] for user in result.data or []])
+        
+        deleted_count = len(result.data) if result.data else 0
+        return jsonify({"status": "success", "message": f"Removed {deleted_count} offline users"})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+    
+
+_sweeper = {'thread': None, 'pid': None}
+_sweeper_lock = threading.Lock()
+
+def sweep_expired(cutoff):
+    """Delete rows last seen before cutoff (ms), SWEEP_BATCH at a time. Returns the count."""
+    deleted = 0
+    while True:
+        # Oldest first, served by idx_timestamp
+        batch = run_query("sweep", supabase.table(TABLE_NAME).select("username").lt("timestamp", cutoff)
+                          .order("timestamp").limit(SWEEP_BATCH)).data
+        if not batch:
+            return deleted
+
+        # Re-check the timestamp so a heartbeat that arrived meanwhile keeps its row
+        result = run_query("sweep", supabase.table(TABLE_NAME).delete()
+                           .in_("username", [user["username"] for user in batch]).lt("timestamp", cutoff))
+        usernames = [user["username"] for user in result.data or []]
+        if usernames:
+            forget_users(usernames)
+        deleted += len(usernames)
+
+        if len(batch) < SWEEP_BATCH:
+            return deleted
+
+def _sweep_loop():
+    # Whoever holds the lock sweeps; the others keep trying in case it exits
+    lock_file = open(SWEEP_LOCK_PATH, "a")
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            time.sleep(SWEEP_INTERVAL)
+
+    while True:
+        try:
+            sweep_expired(int((time.time() - SWEEP_RETENTION) * 1000))
+        except Exception as e:
+            print(f"[ERROR] sweeper: {str(e)}")
+        time.sleep(SWEEP_INTERVAL)
+
+def _ensure_sweeper():
+    if not SWEEP_RETENTION:
+        return
+    if _sweeper['pid'] == os.getpid() and _sweeper['thread'].is_alive():
+        return
+    with _sweeper_lock:
+        if _sweeper['pid'] == os.getpid() and _sweeper['thread'].is_alive():
+            return
+        thread = threading.Thread(target=_sweep_loop, name="sweeper", daemon=True)
+        thread.start()
+        _sweeper['thread'] = thread
+        _sweeper['pid'] = os.getpid()
+
+@app.before_request
+def start_sweeper():
+    _ensure_sweeper()
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+def iter_users(columns="*", seen_after=None):
+    """
+    All rows ordered by username, fetched one keyset page at a time (served
+    by the primary key). seen_after (ms) keeps only rows at least that recent.
+    """
+    last = None
+    while True:
+        query = supabase.table(TABLE_NAME).select(columns).order("username").limit(EXPORT_PAGE_ROWS)
+        if seen_after is not None:
+            query = query.gte("timestamp", seen_after)
+        if last is not None:
+            query = query.gt("username", last)
+        rows = run_query("page_users", query).data
+        yield from rows
+        if len(rows) < EXPORT_PAGE_ROWS:
+            return
+        last = rows[-1]["username"]
+
+class ExportError(Exception):
+    """SheetDB refused a chunk, or kept failing after every retry."""
+
+_export_lock = threading.Lock()  # one export at a time per worker
+_sheet = {'session': None, 'pid': None}
+
+def sheet_session():
+    # Keep-alive connections to SheetDB, reused across chunks and jobs
+    if _sheet['pid'] != os.getpid():
+        _sheet.update(session=requests.Session(), pid=os.getpid())
+    return _sheet['session']
+
+def _job_path(job_id):
+    return f"{EXPORT_PATH}.job.{job_id}.json"
+
+def _state_path(api_url):
+    return f"{EXPORT_PATH}.state.{hashlib.sha256(api_url.encode()).hexdigest()[:16]}.json"
+
+def save_job(job):
+    # Readable from every worker, whichever one runs the job; also its heartbeat
+    job["updated_at"] = time.time()
+    tmp_path = f"{_job_path(job['job_id'])}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(job, f)
+    os.replace(tmp_path, _job_path(job["job_id"]))
+
+def load_job(job_id):
+    try:
+        uuid.UUID(hex=job_id)
+        with open(_job_path(job_id)) as f:
+            job = json.load(f)
+    except (ValueError, FileNotFoundError):
+        return None
+
+    # The worker running it died (restart, OOM kill): it would stay "running" forever
+    if job["status"] in ("queued", "running") and time.time() - job.get("updated_at", job["created_at"]) > EXPORT_STALL_TIMEOUT:
+        job.update(status="error", message="Export stopped responding", finished_at=time.time())
+        save_job(job)
+    return job
+
+def _prune_jobs():
+    for path in glob.glob(f"{EXPORT_PATH}.job.*.json"):
+        try:
+            if time.time() - os.stat(path).st_mtime > EXPORT_JOB_RETENTION:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def upload_chunk(method, url, records):
+    """Send one chunk, retrying timeouts, connection errors, 429 and 5xx with exponential backoff."""
+    for attempt in range(EXPORT_RETRIES + 1):
+        try:
+            started = time.perf_counter()
+            try:
+                response = sheet_session().request(method, url, json={"data": records}, timeout=EXPORT_TIMEOUT)
+            finally:
+                observe("sheetdb_request_duration_seconds", time.perf_counter() - started)
+            if response.status_code in (200, 201):
+                return
+            error = f"SheetDB error: {response.text}"
+            if response.status_code != 429 and response.status_code < 500:
+                raise ExportError(error)
+        except requests.RequestException as e:
+            error = f"SheetDB request failed: {str(e)}"
+
+        if attempt < EXPORT_RETRIES:
+            time.sleep(EXPORT_BACKOFF * 2 ** attempt)
+    raise ExportError(error)
+
+def run_export(job, api_url):
+    # Queued behind another export: keep the heartbeat going while waiting
+    while not _export_lock.acquire(timeout=EXPORT_STALL_TIMEOUT / 4):
+        save_job(job)
+    try:
+        export_to_sheetdb(job, api_url)
+    finally:
+        _export_lock.release()
+
+def export_to_sheetdb(job, api_url):
+    """
+    Stream users from Supabase to SheetDB in chunks. Full mode appends
+    everyone; incremental mode appends new users and updates (batch_update)
+    those whose diamond total changed since the last export to this sheet.
+    """
+    job.update(status="running", started_at=time.time())
+    save_job(job)
+
+    incremental = job["mode"] == "incremental"
+    state_path = _state_path(api_url)
+    try:
+        with open(state_path) as f:
+            previous = json.load(f)
+    except (FileNotFoundError, ValueError):
+        previous = {}
+    # Totals as the sheet has them, updated chunk by chunk so a failed job still counts what it sent
+    exported = dict(previous) if incremental else {}
+    pending = {"POST": [], "PATCH": []}
+
+    def send(method):
+        records = pending[method]
+        if method == "POST":
+            upload_chunk("POST", api_url, records)
+        else:
+            upload_chunk("PATCH", f"{api_url.rstrip('/')}/batch_update", records)
+        for record in records:
+            exported[record["username"]] = int(record["diamonds"])
+        job["sent"] += len(records)
+        pending[method] = []
+        save_job(job)
+
+    try:
+        for user in iter_users("username,diamonds,diamonds_total"):
+            total = row_diamonds_total(user)
+            username = user["username"]
+            if incremental and previous.get(username) == total:
+                job["unchanged"] += 1
+                continue
+
+            record = {"username": username, "diamonds": str(total)}
+            if incremental and username in previous:
+                pending["PATCH"].append({"query": urlencode({"username": username}), **record})
+            else:
+                pending["POST"].append(record)
+
+            for method, records in pending.items():
+                if len(records) >= EXPORT_CHUNK_ROWS:
+                    send(method)
+
+        for method, records in pending.items():
+            if records:
+                send(method)
+
+        job.update(status="success", message=f"Exported {job['sent']} records to Google Sheet")
+    except Exception as e:
+        print(f"[ERROR] export {job['job_id']}: {str(e)}")
+        job.update(status="error", message=str(e))
+    finally:
+        tmp_path = f"{state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(exported, f, separators=(',', ':'))
+        os.replace(tmp_path, state_path)
+
+        job["finished_at"] = time.time()
+        save_job(job)
+
+@app.route("/export_to_sheet", methods=["POST"])
+def export_to_sheet():
+    """
+    Start a background export to a SheetDB API ("mode": "full" or
+    "incremental"). Answers 202 with a job_id; poll /export_jobs/<job_id>.
+    """
+    try:
+        data = request.json
+        sheet_api_url = data.get("api_url")
+        mode = data.get("mode", "full")
+
+        if not sheet_api_url:
+            return jsonify({"status": "error", "message": "API URL required"}), 400
+        if mode not in ("full", "incremental"):
+            return jsonify({"status": "error", "message": "mode must be full or incremental"}), 400
+
+        _prune_jobs()
+        job = {
+            "job_id": uuid.uuid4().hex, "status": "queued", "mode": mode,
+            "sent": 0, "unchanged": 0, "message": None,
+            "created_at": time.time(), "started_at": None, "finished_at": None
+        }
+        save_job(job)
+        threading.Thread(target=run_export, args=(job, sheet_api_url), name="export", daemon=True).start()
+
+        return jsonify({
+            "status": "accepted",
+            "job_id": job["job_id"],
+            "status_url": f"/export_jobs/{job['job_id']}",
+            "message": "Export started"
+        }), 202
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route("/export_jobs/<job_id>", methods=["GET"])
+def export_job(job_id):
+    """Progress of an export: status is queued, running, success or error."""
+    job = load_job(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return jsonify(job)
+
+EXPORT_FIELDS = ("username", "diamonds_total", "diamonds", "device", "status", "timestamp", "last_seen")
+
+def export_records(users, now_ms):
+    seen = seen_map()
+    for user in users:
+        record = format_user(user, now_ms, seen)
+        record["timestamp"] = user["timestamp"]
+        yield record
+
+def encode_export(records, fmt):
+    """CSV or NDJSON text, one chunk per EXPORT_PAGE_ROWS records."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, EXPORT_FIELDS, extrasaction="ignore", lineterminator="\n")
+    if fmt == "csv":
+        writer.writeheader()
+
+    for count, record in enumerate(records, 1):
+        if fmt == "csv":
+            if not isinstance(record["diamonds"], str):
+                record["diamonds"] = json.dumps(record["diamonds"], separators=(',', ':'))
+            writer.writerow(record)
+        else:
+            buffer.write(json.dumps(record, separators=(',', ':')) + "\n")
+
+        if count % EXPORT_PAGE_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route("/export", methods=["GET"])
+def export_users():
+    """
+    The whole users table as CSV (default) or NDJSON (?format=ndjson),
+    streamed page by page so memory stays flat. ?status=online exports
+    only online users. ?gzip=1 downloads a .gz file; otherwise the body
+    is gzipped when the client accepts it.
+    """
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "ndjson"):
+        return jsonify({"status": "error", "message": "format must be csv or ndjson"}), 400
+    online = request.args.get("status") == "online"
+    if request.args.get("status") not in (None, "online"):
+        return jsonify({"status": "error", "message": "status must be online"}), 400
+
+    now_ms = int(time.time() * 1000)
+    # Same superset as the online snapshot, narrowed to ONLINE below
+    seen_after = now_ms - int((TIMEOUT + max(HEARTBEAT_REFRESH, 0)) * 1000) if online else None
+    users = iter_users(SNAPSHOT_COLUMNS, seen_after)
+    try:
+        # Fetch the first page now so a Supabase failure is still a proper error response
+        first = next(users, None)
+    except Exception as e:
+        print(f"[ERROR] export: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+    def rows():
+        if first is None:
+            return
+        yield first
+        try:
+            yield from users
+        except Exception as e:
+            # Headers are gone already: the download ends short
+            print(f"[ERROR] export: {str(e)}")
+
+    records = export_records(rows(), now_ms)
+    if online:
+        records = (record for record in records if record["status"] == "ONLINE")
+    chunks = encode_export(records, fmt)
+    filename = f"users-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    headers = {"Cache-Control": "no-store", "X-Accel-Buffering": "no"}
+
+    if request.args.get("gzip") == "1":
+        filename += ".gz"
+        mimetype = "application/gzip"
+        chunks = gzip_stream(chunks)
+    elif "gzip" in request.headers.get("Accept-Encoding", "").lower():
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+        chunks = gzip_stream(chunks)
+
+    headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+# Profiles of sampled requests, merged per route (this worker only).
+# cProfile allows one active profiler at a time, so concurrent samples are skipped.
+_profiles = {}  # route -> pstats.Stats
+_profile_counts = {}  # route -> sampled requests
+_profile_lock = threading.Lock()
+_profile_active = threading.Lock()
+_profile_counter = itertools.count(1)
+
+def profiling_enabled():
+    return PROFILE_SAMPLE > 0 or bool(PROFILE_TOKEN)
+
+def _profile_authorized():
+    # Header only: a query string token would end up in access logs
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(request.headers.get("X-Profile", ""), PROFILE_TOKEN)
+
+@app.before_request
+def start_profile():
+    if not profiling_enabled():
+        return
+    sampled = PROFILE_SAMPLE > 0 and next(_profile_counter) % PROFILE_SAMPLE == 0
+    if not sampled and not _profile_authorized():
+        return
+    if request.path.startswith("/debug/profile") or not _profile_active.acquire(blocking=False):
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Some other profiler is active in this process
+        _profile_active.release()
+        return
+    g.profiler = profiler
+
+@app.teardown_request
+def stop_profile(exc=None):
+    # Teardown runs after every after_request hook, so compression is included
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return
+    profiler.disable()
+    _profile_active.release()
+
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    with _profile_lock:
+        if route in _profiles:
+            _profiles[route].add(profiler)
+        else:
+            _profiles[route] = pstats.Stats(profiler)
+        _profile_counts[route] = _profile_counts.get(route, 0) + 1
+
+def hot_functions(stats, sort):
+    """The PROFILE_TOP most expensive functions, by own time (tottime) or cumulative time."""
+    rows = []
+    for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            "function": f"{function} ({os.path.basename(filename)}:{line})" if line else function,
+            "calls": calls,
+            "tottime": round(tottime, 6),
+            "cumtime": round(cumtime, 6)
+        })
+    rows.sort(key=lambda row: row[sort], reverse=True)
+    return rows[:PROFILE_TOP]
+
+@app.route("/debug/profile", methods=["GET", "DELETE"])
+def debug_profile():
+    """
+    Hot functions of sampled requests per route (?sort=tottime|cumtime,
+    ?route= to pick one); DELETE clears the samples. Needs PROFILE_TOKEN
+    set and sent as X-Profile. Per worker.
+    """
+    if not profiling_enabled() or not PROFILE_TOKEN:
+        return jsonify({"status": "error", "message": "Profiling is off or PROFILE_TOKEN is not set"}), 404
+    if not _profile_authorized():
+        return jsonify({"status": "error", "message": "Invalid profile token"}), 403
+
+    if request.method == "DELETE":
+        with _profile_lock:
+            _profiles.clear()
+            _profile_counts.clear()
+        return jsonify({"status": "success"})
+
+    sort = request.args.get("sort", "tottime")
+    if sort not in ("tottime", "cumtime"):
+        return jsonify({"status": "error", "message": "sort must be tottime or cumtime"}), 400
+    route = request.args.get("route")
+
+    with _profile_lock:
+        return jsonify({
+            name: {"samples": _profile_counts[name], "functions": hot_functions(stats, sort)}
+            for name, stats in _profiles.items() if route in (None, name)
+        })
+
+@app.route("/debug/profile.pstats", methods=["GET"])
+def debug_profile_dump():
+    """Samples (of one ?route= or all routes) as a pstats file: python -m pstats <file>."""
+    if not profiling_enabled() or not PROFILE_TOKEN:
+        return jsonify({"status": "error", "message": "Profiling is off or PROFILE_TOKEN is not set"}), 404
+    if not _profile_authorized():
+        return jsonify({"status": "error", "message": "Invalid profile token"}), 403
+
+    route = request.args.get("route")
+    with _profile_lock:
+        selected = [stats for name, stats in _profiles.items() if route in (None, name)]
+        if not selected:
+            return jsonify({"status": "error", "message": "No samples yet"}), 404
+        merged = pstats.Stats()
+        merged.add(*selected)
+        body = marshal.dumps(merged.stats)
+
+    return Response(body, mimetype="application/octet-stream", headers={
+        "Content-Disposition": f'attachment; filename="profile-{os.getpid()}.pstats"'
+    })
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus text format, summed over every worker on this host."""
+    return Response(render_metrics(collect_metrics()), mimetype="text/plain; version=0.0.4")
+
+@app.after_request
+def record_request(response):
+    # Runs after compress_response (hooks run in reverse), so compression is timed too
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    inc("http_requests_total", route=route, method=request.method, status=response.status_code)
+    if "request_started" in g:
+        observe("http_request_duration_seconds", time.perf_counter() - g.request_started, route=route)
+    return response
 
 @app.after_request
 def compress_response(response):
@@ -852,7 +3594,7 @@ def compress_response(response):
     if 'gzip' not in accept_encoding.lower():
         return response
     
-    if response.direct_passthrough:
+    if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
         return response
     
     response.direct_passthrough = False
@@ -860,6 +3602,7 @@ def compress_response(response):
     
     if len(response_data) > 500:
         gzip_buffer = gzip.compress(response_data, compresslevel=6)
+        inc("gzip_bytes_saved_total", len(response_data) - len(gzip_buffer))
         response.set_data(gzip_buffer)
         response.headers['Content-Encoding'] = 'gzip'
         response.headers['Content-Length'] = len(gzip_buffer)
@@ -870,7 +3613,13 @@ if __name__ == "__main__":
     port = int(os.environ.get('PORT', 5000))
     print(f"🚀 Starting Diamond Monitor with Supabase on port {port}")
     print(f"⏱️  Timeout: {TIMEOUT}s | Cache TTL: {CACHE_TTL}s")
+    print(f"📝 Write-behind: {'on' if WRITE_BEHIND else 'off'} | Flush: {FLUSH_INTERVAL}s / {FLUSH_MAX_ROWS} rows")
+    if SWEEP_RETENTION:
+        print(f"🧹 Sweeper: rows idle > {SWEEP_RETENTION}s, every {SWEEP_INTERVAL}s")
     print(f"📊 Supabase URL: {SUPABASE_URL}")
+    # The development server starts a thread per request, so streams can't starve it
+    MAX_STREAM_CLIENTS = int(os.environ.get("MAX_STREAM_CLIENTS", 200))
+    _ensure_sweeper()
     app.run(host="0.0.0.0", port=port, debug=False, threaded=True)
 
 
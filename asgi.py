@@ -0,0 +1,584 @@
+"""
+Async serving mode for the Diamond Monitor:
+
+    uvicorn asgi:app --workers 4
+    gunicorn -k uvicorn.workers.UvicornWorker -w 4 asgi:app
+
+/send_data, /send_batch, /get_data and the delete routes run on the event
+loop and talk to Supabase through one pooled async PostgREST client per
+worker (HTTP/2, keep-alive), so a slow Supabase round trip no longer ties
+up a thread. The page, /app.js, /stats and /stream are served natively
+too; an open stream costs no thread. Everything else is served by the
+Flask app on a thread pool. Request and response bodies are the same in
+both modes.
+"""
+import asyncio
+import fcntl
+import gzip
+import json
+import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import httpx
+from asgiref.sync import SyncToAsync
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from postgrest import AsyncPostgrestClient
+
+import app as monitor
+
+# Connection pool to Supabase, per worker
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", 100))
+UPSTREAM_MAX_KEEPALIVE = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE", 20))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", 30.0))  # seconds an idle connection is kept
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", 10.0))
+
+WSGI_THREADS = int(os.environ.get("WSGI_THREADS", 16))  # threads for routes handed to the Flask app
+MAX_STREAM_CLIENTS = int(os.environ.get("MAX_STREAM_CLIENTS", 1000))  # per worker; streams don't hold threads here
+
+TABLE_NAME = monitor.TABLE_NAME
+
+class PooledPostgrestClient(AsyncPostgrestClient):
+    """AsyncPostgrestClient whose session keeps a bounded pool of HTTP/2 connections alive."""
+
+    def create_session(self, base_url, headers, timeout, verify=True, proxy=None):
+        return httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            verify=verify,
+            proxy=proxy,
+            follow_redirects=True,
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY
+            )
+        )
+
+_db = {'client': None}
+_refresh = {'tasks': {}}  # mode -> background refresh task
+
+def db():
+    # Created on startup; lazily too, for servers without lifespan support
+    if _db['client'] is None:
+        _db['client'] = PooledPostgrestClient(
+            f"{monitor.SUPABASE_URL}/rest/v1",
+            headers={
+                "apikey": monitor.SUPABASE_KEY,
+                "Authorization": f"Bearer {monitor.SUPABASE_KEY}",
+                "Accept": "application/json",
+                "Content-Type": "application/json"
+            },
+            timeout=UPSTREAM_TIMEOUT
+        )
+    return _db['client']
+
+async def run_query(operation, query):
+    """Async run_query: awaits query.execute() and feeds the same metrics."""
+    started = time.perf_counter()
+    try:
+        return await query.execute()
+    except Exception:
+        monitor.inc("supabase_errors_total", operation=operation)
+        raise
+    finally:
+        monitor.observe("supabase_request_duration_seconds", time.perf_counter() - started, operation=operation)
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        self.body = body
+
+    @property
+    def json(self):
+        try:
+            data = json.loads(self.body or b"null")
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+    def response_format(self):
+        if self.args.get("format") == "columnar" or monitor.COLUMNAR_MIMETYPE in self.headers.get("accept", ""):
+            return "columnar"
+        return "json"
+
+def jsonify(payload, status=200):
+    body = json.dumps(payload, separators=(',', ':')).encode()
+    return status, [("content-type", "application/json")], body
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+async def send_response(request, send, status, headers, body):
+    headers = [("access-control-allow-origin", "*")] + headers
+    names = {name for name, _ in headers}
+    if (
+        200 <= status < 300 and "content-encoding" not in names and len(body) > 500
+        and "gzip" in request.headers.get("accept-encoding", "").lower()
+    ):
+        compressed = gzip.compress(body, compresslevel=6)
+        monitor.inc("gzip_bytes_saved_total", len(body) - len(compressed))
+        body = compressed
+        headers.append(("content-encoding", "gzip"))
+    headers.append(("content-length", str(len(body))))
+
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+# Snapshot: same shared file, generation counter and lock as the Flask routes
+
+async def load_snapshot(now, mode="all", allow_stale=True):
+    # Re-parses the snapshot file when another worker replaced it
+    rows, stale = await asyncio.to_thread(monitor.cached_snapshot, now, mode, allow_stale)
+    if rows is None:
+        return await refresh_snapshot(wait=True, mode=mode)
+    task = _refresh['tasks'].get(mode)
+    if stale and (task is None or task.done()):
+        _refresh['tasks'][mode] = asyncio.create_task(_background_refresh(mode))
+    return rows
+
+async def refresh_snapshot(wait=True, mode="all"):
+    """Async refresh_snapshot: polls the snapshot lock instead of blocking the loop on it."""
+    lock_file = open(monitor.snapshot_path(mode) + ".lock", "a")
+    try:
+        waited_from = time.time()
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not wait:
+                    return None
+                await asyncio.sleep(0.01)
+
+        generation = monitor.read_generation()
+        rows = await asyncio.to_thread(monitor.reusable_snapshot, generation, waited_from, wait, mode)
+        if rows is not None:
+            return rows
+
+        now = time.time()
+        response = await run_query("snapshot", monitor.snapshot_query(db().from_(TABLE_NAME), mode, now))
+        return await asyncio.to_thread(monitor.store_snapshot, response.data, generation, mode, now)
+    finally:
+        lock_file.close()
+
+async def _background_refresh(mode):
+    try:
+        await refresh_snapshot(wait=False, mode=mode)
+    except Exception as e:
+        print(f"[ERROR] background refresh: {str(e)}")
+
+# Routes
+
+async def send_data(request):
+    try:
+        data = request.json
+        if not data:
+            return jsonify({"status": "error", "message": "No JSON received"}, 400)
+
+        row = monitor.build_user_row(data)
+        monitor.record_history([row])
+        monitor.inc("ingested_rows_total", route="/send_data")
+
+        await store_rows([row])
+        monitor.notify_changes([row])
+
+        return jsonify({"status": "success"})
+    except Exception as e:
+        print(f"[ERROR] {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}, 500)
+
+async def send_batch(request):
+    try:
+        try:
+            records = monitor.decode_batch(request.body, request.headers.get("content-encoding", ""))
+            rows, rejected = monitor.build_batch_rows(records)
+        except monitor.BatchError as e:
+            return jsonify({"status": "error", "message": str(e)}, e.status)
+
+        if rows:
+            monitor.record_history(rows.values())
+            monitor.inc("ingested_rows_total", len(rows), route="/send_batch")
+            await store_rows(rows.values())
+            monitor.notify_changes(rows.values())
+
+        return jsonify({"status": "success", "accepted": len(rows), "rejected": rejected})
+    except Exception as e:
+        print(f"[ERROR] receive_batch: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}, 500)
+
+async def upsert_rows(rows):
+    await run_query("upsert", db().from_(TABLE_NAME).upsert(rows, on_conflict="username"))
+    await asyncio.to_thread(monitor.invalidate_snapshot)
+
+async def store_rows(rows):
+    # Same as monitor.store_rows, with the upsert awaited (changed_rows may read the tombstone log)
+    rows = await asyncio.to_thread(monitor.changed_rows, rows)
+    if not rows:
+        return
+    if monitor.WRITE_BEHIND:
+        monitor.enqueue_rows(rows)
+        return
+    try:
+        await upsert_rows(rows)
+    except Exception:
+        monitor.forget_heartbeats([row["username"] for row in rows])
+        raise
+
+async def get_data(request):
+    fmt = request.response_format()
+    try:
+        since = int(request.args["since"]) if "since" in request.args else None
+    except ValueError:
+        since = None
+
+    try:
+        if since is not None:
+            return jsonify(await get_data_delta(since, fmt))
+
+        mode = monitor.snapshot_mode(request.args)
+        if mode is None:
+            # The live index is guarded by thread locks
+            payload, status = await asyncio.to_thread(monitor.page_payload, request.args, fmt)
+            return jsonify(payload, status)
+
+        now = time.time()
+        rows = await load_snapshot(now, mode)
+        # Encoded once per snapshot, but that once is a full JSON dump
+        body, etag = await asyncio.to_thread(monitor.encode_snapshot, rows, now, fmt, mode)
+    except Exception as e:
+        print(f"[ERROR] get_data: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}, 500)
+
+    async def compressed():
+        return await asyncio.to_thread(monitor.snapshot_gzip, body, fmt, mode)
+
+    content_type = monitor.COLUMNAR_MIMETYPE if fmt == "columnar" else "application/json"
+    return await encoded_response(request, body, etag, content_type, compressed)
+
+async def encoded_response(request, body, etag, content_type, compressed=None, cache_control="no-cache"):
+    """Async encoded_response: gzip variant when accepted, 304 on a matching If-None-Match."""
+    headers = [
+        ("content-type", content_type),
+        ("vary", "Accept, Accept-Encoding"),
+        ("cache-control", cache_control)
+    ]
+    if compressed and "gzip" in request.headers.get("accept-encoding", "").lower() and len(body) > 500:
+        gzipped = await compressed()
+        monitor.inc("gzip_bytes_saved_total", len(body) - len(gzipped))
+        body = gzipped
+        headers.append(("content-encoding", "gzip"))
+        etag += "-gzip"
+    headers.append(("etag", f'"{etag}"'))
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match == "*" or f'"{etag}"' in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return 304, headers, b""
+    return 200, headers, body
+
+async def get_data_delta(since, fmt):
+    now = time.time()
+    # Reads (and may start) the tombstone log under a file lock
+    reset, entries = await asyncio.to_thread(monitor.delta_window, since, now)
+    if reset:
+        rows, deleted = await load_snapshot(now, allow_stale=False), []
+        cursor = monitor.reset_cursor(rows, now)
+    else:
+        response = await run_query("changes", db().from_(TABLE_NAME).select(monitor.SNAPSHOT_COLUMNS).gte(
+            "timestamp", since - monitor.DELTA_OVERLAP_MS
+        ))
+        rows = response.data
+        deleted = monitor.deleted_since(entries, since, rows)
+        cursor = int(now * 1000)
+
+    # Merges the other workers' last-seen files
+    delta = await asyncio.to_thread(monitor.build_delta, now, since, reset, rows, deleted, cursor)
+    if fmt == "columnar":
+        delta["users"] = monitor.encode_columnar(delta["users"])
+    return delta
+
+async def delete_user(request):
+    try:
+        data = request.json or {}
+        username = data.get("username")
+
+        if not username:
+            return jsonify({"status": "error", "message": "Username required"}, 400)
+
+        await asyncio.to_thread(monitor.discard_pending, [username])
+        await run_query("delete_user", db().from_(TABLE_NAME).delete().eq("username", username))
+        await asyncio.to_thread(monitor.forget_users, [username])
+
+        return jsonify({"status": "success"})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}, 500)
+
+async def delete_all(request):
+    try:
+        await asyncio.to_thread(monitor.discard_pending)
+        await run_query("delete_all", db().from_(TABLE_NAME).delete().gt("timestamp", 0))
+        await asyncio.to_thread(monitor.forget_users)
+
+        return jsonify({"status": "success"})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}, 500)
+
+async def delete_users(request):
+    try:
+        try:
+            usernames, criteria = monitor.bulk_delete_criteria(request.json)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}, 400)
+
+        now_ms = int(time.time() * 1000)
+        deleted = []
+        if usernames:
+            if not criteria:
+                await asyncio.to_thread(monitor.discard_pending, usernames)
+            for i in range(0, len(usernames), monitor.BULK_DELETE_CHUNK):
+                chunk = usernames[i:i + monitor.BULK_DELETE_CHUNK]
+                query = monitor.filtered(db().from_(TABLE_NAME).delete().in_("username", chunk), criteria, now_ms)
+                result = await run_query("delete_users", query)
+                deleted.extend(user["username"] for user in result.data or [])
+        else:
+            result = await run_query("delete_users", monitor.filtered(db().from_(TABLE_NAME).delete(), criteria, now_ms))
+            deleted = [user["username"] for user in result.data or []]
+
+        if "diamonds_below" in criteria:
+            # Rows with no diamonds_total yet: compare their parsed totals, as the Flask route does
+            chunk_size = monitor.BULK_DELETE_CHUNK
+            legacy = []
+            for chunk in [usernames[i:i + chunk_size] for i in range(0, len(usernames), chunk_size)] if usernames else [None]:
+                query = monitor.filtered(db().from_(TABLE_NAME).select("username,diamonds"), criteria, now_ms, legacy=True)
+                if chunk is not None:
+                    query = query.in_("username", chunk)
+                legacy.extend(monitor.legacy_below((await run_query("delete_users", query)).data or [], criteria))
+            for i in range(0, len(legacy), chunk_size):
+                query = monitor.filtered(db().from_(TABLE_NAME).delete().in_("username", legacy[i:i + chunk_size]), criteria, now_ms, legacy=True)
+                result = await run_query("delete_users", query)
+                deleted.extend(user["username"] for user in result.data or [])
+
+        if deleted:
+            await asyncio.to_thread(monitor.discard_pending, deleted)
+            await asyncio.to_thread(monitor.forget_users, deleted)
+
+        return jsonify({"status": "success", "deleted": len(deleted), "message": f"Removed {len(deleted)} users"})
+    except Exception as e:
+        print(f"[ERROR] delete_users: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}, 500)
+
+async def cleanup_offline(request):
+    try:
+        cutoff = int(time.time() * 1000) - int(monitor.OFFLINE_AFTER * 1000)
+
+        result = await run_query("cleanup_offline", db().from_(TABLE_NAME).delete().lt("timestamp", cutoff))
+        await asyncio.to_thread(monitor.forget_users, [user["username"] for user in result.data or []])
+
+        deleted_count = len(result.data) if result.data else 0
+        return jsonify({"status": "success", "message": f"Removed {deleted_count} offline users"})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}, 500)
+
+async def index(request):
+    asset = monitor._index_assets[MAX_STREAM_CLIENTS > 0]
+    return await asset_response(request, asset)
+
+async def app_js(request):
+    # The page links this with ?v=<etag>, so it can be cached for good
+    return await asset_response(request, monitor._app_asset, "public, max-age=31536000, immutable")
+
+async def asset_response(request, asset, cache_control="no-cache"):
+    async def compressed():
+        return asset["gzip"]
+    return await encoded_response(request, asset["body"], asset["etag"], asset["mimetype"], compressed, cache_control)
+
+async def get_stats(request):
+    monitor._stream['last_read'] = time.time()
+    monitor._ensure_stream_loop()
+
+    if not await wait_live_ready():
+        return jsonify({"status": "error", "message": "Stats not ready yet"}, 503)
+    return jsonify(monitor._stats['snapshot'])
+
+async def wait_live_ready(timeout=5):
+    # The event is set by the live loop thread; poll it rather than park a thread on it
+    deadline = time.monotonic() + timeout
+    while not monitor._stream_ready.is_set():
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+class StreamSubscriber:
+    """
+    A /stream client for the live loop's publish_event(): messages put from
+    the loop's thread are handed to an asyncio queue on the event loop.
+    """
+
+    def __init__(self, loop, maxsize=256):
+        self.loop = loop
+        self.messages = asyncio.Queue(maxsize)
+
+    def put_nowait(self, message):
+        if self.messages.full():
+            raise queue.Full
+        self.loop.call_soon_threadsafe(self._put, message)
+
+    def _put(self, message):
+        try:
+            self.messages.put_nowait(message)
+        except asyncio.QueueFull:
+            # Too slow to keep up, same as publish_event: drop it, the browser reconnects
+            with monitor._stream_lock:
+                monitor._subscribers.discard(self)
+
+async def stream(scope, receive, send):
+    """Native /stream: same events as the Flask route, without a thread per client. Returns the status sent."""
+    request = Request(scope, await read_body(receive))
+    if MAX_STREAM_CLIENTS <= 0:
+        await send_response(request, send, *jsonify({"status": "error", "message": "Streaming is disabled on this server"}, 503))
+        return 503
+
+    try:
+        since = int(request.headers.get("last-event-id", 0))
+    except ValueError:
+        since = 0
+    subscriber = StreamSubscriber(asyncio.get_running_loop())
+
+    with monitor._stream_lock:
+        if len(monitor._subscribers) >= MAX_STREAM_CLIENTS:
+            await send_response(request, send, *jsonify({"status": "error", "message": "Too many stream clients"}, 503))
+            return 503
+        monitor._subscribers.add(subscriber)
+    monitor._ensure_stream_loop()
+
+    try:
+        try:
+            snapshot = await get_data_delta(since, "json")
+        except Exception as e:
+            print(f"[ERROR] stream: {str(e)}")
+            await send_response(request, send, *jsonify({"status": "error", "message": str(e)}, 500))
+            return 500
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+                (b"access-control-allow-origin", b"*")
+            ]
+        })
+        first = "retry: 3000\n" + monitor.format_event("delta", snapshot, snapshot["cursor"])
+        if monitor._stats['snapshot']:
+            first += monitor.format_event("stats", monitor._stats['snapshot'])
+        await send({"type": "http.response.body", "body": first.encode(), "more_body": True})
+
+        disconnected = asyncio.ensure_future(receive())
+        try:
+            while subscriber in monitor._subscribers:
+                message = asyncio.ensure_future(subscriber.messages.get())
+                done, _ = await asyncio.wait(
+                    {message, disconnected}, timeout=monitor.STREAM_KEEPALIVE, return_when=asyncio.FIRST_COMPLETED
+                )
+                if disconnected in done:
+                    message.cancel()
+                    return 200
+                if message not in done:
+                    message.cancel()
+                    chunk = ": keepalive\n\n"
+                else:
+                    chunk = message.result()
+                await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+            return 200
+        finally:
+            disconnected.cancel()
+    finally:
+        with monitor._stream_lock:
+            monitor._subscribers.discard(subscriber)
+
+ROUTES = {
+    ("GET", "/"): index,
+    ("GET", "/app.js"): app_js,
+    ("GET", "/stats"): get_stats,
+    ("POST", "/send_data"): send_data,
+    ("POST", "/send_batch"): send_batch,
+    ("GET", "/get_data"): get_data,
+    ("POST", "/delete_user"): delete_user,
+    ("POST", "/delete_users"): delete_users,
+    ("POST", "/delete_all"): delete_all,
+    ("POST", "/cleanup_offline"): cleanup_offline
+}
+
+class ThreadedWsgiToAsgiInstance(WsgiToAsgiInstance):
+    # asgiref runs WSGI calls one at a time on a single shared thread by default
+    run_wsgi_app = SyncToAsync(
+        WsgiToAsgiInstance.__dict__["run_wsgi_app"].func, thread_sensitive=False,
+        executor=ThreadPoolExecutor(WSGI_THREADS, thread_name_prefix="wsgi")
+    )
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi that serves WSGI requests concurrently on a thread pool."""
+
+    async def __call__(self, scope, receive, send):
+        await ThreadedWsgiToAsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+_flask = ThreadedWsgiToAsgi(monitor.app)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            db()
+            monitor._ensure_sweeper()
+            print(f"🚀 Diamond Monitor (ASGI) | Supabase pool: {UPSTREAM_MAX_CONNECTIONS} connections")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await asyncio.to_thread(monitor.flush_write_buffer)
+            if _db['client'] is not None:
+                await _db['client'].aclose()
+                _db['client'] = None
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+
+    if scope["type"] == "http" and (scope["method"], scope["path"]) == ("GET", "/stream"):
+        status = await stream(scope, receive, send)
+        monitor.inc("http_requests_total", route="/stream", method="GET", status=status)
+        return
+
+    handler = ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if handler is None:
+        # /history, exports, /metrics, debug routes and CORS preflights
+        await _flask(scope, receive, send)
+        return
+
+    started = time.perf_counter()
+    request = Request(scope, await read_body(receive))
+    status, headers, body = await handler(request)
+    await send_response(request, send, status, headers, body)
+
+    monitor.inc("http_requests_total", route=request.path, method=request.method, status=status)
+    monitor.observe("http_request_duration_seconds", time.perf_counter() - started, route=request.path)
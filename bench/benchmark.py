@@ -0,0 +1,221 @@
+"""
+Load test for the Diamond Monitor against the in-memory PostgREST fake:
+N devices post /send_data on a heartbeat, M dashboards poll /get_data the
+way the dashboard does, and the run ends with one JSON document of
+throughput and p50/p95/p99 latency per route (stdout, or --output).
+
+    python bench/benchmark.py --devices 500 --dashboards 20 --duration 30 --latency-ms 20
+    python bench/benchmark.py --server asgi ...
+    python bench/benchmark.py --app-url http://127.0.0.1:5000 ...   (an app you started yourself,
+                                                                       pointed at bench/fake_postgrest.py)
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_postgrest import serve  # noqa: E402
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}  # route -> [seconds]
+        self.errors = {}  # route -> count
+
+    def add(self, route, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, duration):
+        routes = {}
+        for route, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            routes[route] = {
+                "requests": len(samples),
+                "errors": self.errors.get(route, 0),
+                "throughput_rps": round(len(samples) / duration, 2),
+                **{
+                    f"p{int(q * 100)}_ms": round(percentile(samples, q) * 1000, 2)
+                    for q in (0.5, 0.95, 0.99)
+                },
+                "max_ms": round(samples[-1] * 1000, 2)
+            }
+        return routes
+
+def timed(recorder, route, send):
+    started = time.perf_counter()
+    try:
+        response = send()
+        ok = response.status_code < 400
+    except httpx.HTTPError:
+        response, ok = None, False
+    recorder.add(route, time.perf_counter() - started, ok)
+    return response
+
+def device(base_url, index, args, recorder, stop):
+    username = f"bench-{index}"
+    diamonds = random.randint(0, 1000)
+    with httpx.Client(base_url=base_url, timeout=30) as client:
+        # Spread the first heartbeats over one interval, like devices booting at different times
+        stop.wait(random.uniform(0, args.heartbeat))
+        while not stop.is_set():
+            started = time.monotonic()
+            if random.random() < args.change_rate:
+                diamonds += random.randint(1, 10)
+            timed(recorder, "/send_data", lambda: client.post("/send_data", json={
+                "username": username,
+                "diamonds": diamonds,
+                "device": f"device-{index % args.device_groups}"
+            }))
+            stop.wait(max(args.heartbeat - (time.monotonic() - started), 0))
+
+def dashboard(base_url, args, recorder, stop):
+    cursor = 0
+    with httpx.Client(base_url=base_url, timeout=30, headers={"Accept-Encoding": "gzip"}) as client:
+        stop.wait(random.uniform(0, args.poll))
+        while not stop.is_set():
+            started = time.monotonic()
+            if args.dashboard_mode == "delta":
+                response = timed(recorder, "/get_data?since=", lambda: client.get(f"/get_data?since={cursor}&format=columnar"))
+                if response is not None and response.status_code == 200:
+                    cursor = response.json()["cursor"]
+            else:
+                timed(recorder, "/get_data", lambda: client.get("/get_data"))
+            stop.wait(max(args.poll - (time.monotonic() - started), 0))
+
+def start_app(args, supabase_url):
+    """Run the app in this process on a free port. Returns its base URL."""
+    workdir = tempfile.mkdtemp(prefix="diamond_bench_")
+    os.environ.update({
+        "SUPABASE_URL": supabase_url,
+        "SUPABASE_KEY": "bench.bench.bench",
+        # A fresh state directory per run, so earlier runs can't leak in
+        "STATE_DIR": workdir
+    })
+
+    import app as monitor  # noqa: F401
+    if args.server == "asgi":
+        import asgi
+
+    if args.server == "asgi":
+        import uvicorn
+
+        config = uvicorn.Config(asgi.app, host="127.0.0.1", port=0, log_level="warning")
+        server = uvicorn.Server(config)
+        threading.Thread(target=server.run, name="bench-app", daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+        port = server.servers[0].sockets[0].getsockname()[1]
+    else:
+        from werkzeug.serving import make_server
+
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        server = make_server("127.0.0.1", 0, monitor.app, threaded=True)
+        threading.Thread(target=server.serve_forever, name="bench-app", daemon=True).start()
+        port = server.server_port
+    return f"http://127.0.0.1:{port}"
+
+def run(args):
+    """Start the fake and the app (unless --app-url), apply the load, return the result."""
+    if args.app_url:
+        # Supabase calls then go wherever that app points (e.g. bench/fake_postgrest.py)
+        base_url, table = args.app_url, None
+    else:
+        fake, table = serve(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms)
+        base_url = start_app(args, f"http://127.0.0.1:{fake.server_port}")
+
+    recorder = Recorder()
+    stop = threading.Event()
+    workers = [
+        threading.Thread(target=device, args=(base_url, i, args, recorder, stop), daemon=True)
+        for i in range(args.devices)
+    ] + [
+        threading.Thread(target=dashboard, args=(base_url, args, recorder, stop), daemon=True)
+        for _ in range(args.dashboards)
+    ]
+    for worker in workers:
+        worker.start()
+
+    time.sleep(args.warmup)
+    with recorder.lock:
+        recorder.samples.clear()
+        recorder.errors.clear()
+    if table is not None:
+        with table.lock:
+            table.requests.clear()
+    started = time.monotonic()
+    time.sleep(args.duration)
+    elapsed = time.monotonic() - started
+    with recorder.lock:
+        routes = recorder.summary(elapsed)
+    if table is not None:
+        with table.lock:
+            supabase_requests = dict(table.requests)
+
+    stop.set()
+    for worker in workers:
+        worker.join(timeout=5)
+
+    result = {
+        "config": {
+            key: value for key, value in vars(args).items() if key != "output"
+        },
+        "elapsed_s": round(elapsed, 2),
+        "routes": routes
+    }
+    if table is not None:
+        result["supabase_requests"] = supabase_requests
+        result["supabase_rps"] = round(sum(supabase_requests.values()) / elapsed, 2)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=200, help="simulated devices posting /send_data")
+    parser.add_argument("--dashboards", type=int, default=10, help="simulated dashboards polling /get_data")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds to run after warm-up")
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds of load before measuring")
+    parser.add_argument("--heartbeat", type=float, default=1.0, help="seconds between a device's posts")
+    parser.add_argument("--poll", type=float, default=2.0, help="seconds between a dashboard's polls")
+    parser.add_argument("--change-rate", type=float, default=0.3, help="share of heartbeats that change diamonds")
+    parser.add_argument("--device-groups", type=int, default=10, help="distinct device names")
+    parser.add_argument("--dashboard-mode", choices=("delta", "full"), default="delta",
+                        help="delta: /get_data?since=&format=columnar like the dashboard; full: plain /get_data")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="delay the fake adds to every Supabase call")
+    parser.add_argument("--jitter-ms", type=float, default=5.0)
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask", help="in-process server to run")
+    parser.add_argument("--app-url", help="benchmark an already running app instead of starting one")
+    parser.add_argument("--output", help="write the JSON result here instead of stdout")
+    args = parser.parse_args()
+
+    # Whatever the app prints (startup banners, [ERROR] lines, also from the
+    # uvicorn thread) goes to stderr, so stdout carries nothing but the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        result = run(args)
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
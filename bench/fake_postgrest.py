@@ -0,0 +1,151 @@
+"""
+In-memory stand-in for the Supabase REST API (PostgREST), enough of it for
+app.py: select with column lists, eq/neq/gt/gte/lt/lte/in/is filters, order,
+limit/offset, upsert (on_conflict) and delete with return=representation.
+Every request can be delayed to mimic the network round trip.
+
+    python bench/fake_postgrest.py --port 54321 --latency-ms 20
+    SUPABASE_URL=http://127.0.0.1:54321 SUPABASE_KEY=bench.bench.bench gunicorn ... app:app
+"""
+import argparse
+import csv
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+OPERATORS = {
+    "eq": lambda a, b: a == b,
+    "neq": lambda a, b: a != b,
+    "gt": lambda a, b: a > b,
+    "gte": lambda a, b: a >= b,
+    "lt": lambda a, b: a < b,
+    "lte": lambda a, b: a <= b
+}
+RESERVED_PARAMS = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+
+class Table:
+    def __init__(self, key="username"):
+        self.key = key
+        self.rows = {}
+        self.lock = threading.Lock()
+        self.requests = {}  # method -> count
+
+def _coerce(value, sample):
+    # Compare like Postgres would: numbers as numbers, everything else as text
+    if isinstance(sample, bool):
+        return value == "true"
+    if isinstance(sample, (int, float)):
+        return float(value)
+    return value
+
+def _matcher(column, expression):
+    operator, _, value = expression.partition(".")
+    if operator == "is":
+        # is.null / is.true / is.false: identity, so NULL never equals false
+        target = {"null": None, "true": True, "false": False}[value]
+        return lambda row: row.get(column) is target
+    if operator == "in":
+        values = set(next(csv.reader([value[1:-1]], escapechar="\\")))
+        return lambda row: row.get(column) is not None and str(row[column]) in values
+    compare = OPERATORS[operator]
+    return lambda row: row.get(column) is not None and compare(row[column], _coerce(value, row[column]))
+
+def select_rows(table, params):
+    """Rows matching the filters, ordered and sliced. Call with table.lock held."""
+    filters = [_matcher(k, v) for k, v in params if k not in RESERVED_PARAMS]
+    rows = [row for row in table.rows.values() if all(f(row) for f in filters)]
+
+    options = dict(params)
+    for term in reversed(options["order"].split(",") if "order" in options else []):
+        column, *flags = term.split(".")
+        rows.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse="desc" in flags)
+    offset = int(options.get("offset", 0))
+    limit = int(options["limit"]) if "limit" in options else None
+    return rows[offset:offset + limit if limit is not None else None]
+
+def project(rows, params):
+    columns = dict(params).get("select", "*")
+    if columns == "*":
+        return [dict(row) for row in rows]
+    columns = [c.strip() for c in columns.split(",")]
+    return [{c: row.get(c) for c in columns} for row in rows]
+
+def make_handler(table, latency, jitter):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status, payload=None):
+            body = json.dumps(payload).encode() if payload is not None else b""
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self):
+            if latency or jitter:
+                time.sleep(max(latency + random.uniform(-jitter, jitter), 0))
+            url = urlsplit(self.path)
+            params = parse_qsl(url.query, keep_blank_values=True)
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            representation = "return=representation" in self.headers.get("Prefer", "")
+
+            with table.lock:
+                table.requests[self.command] = table.requests.get(self.command, 0) + 1
+                if self.command == "GET":
+                    return 200, project(select_rows(table, params), params)
+
+                if self.command == "POST":
+                    rows = json.loads(body or b"[]")
+                    rows = rows if isinstance(rows, list) else [rows]
+                    for row in rows:
+                        table.rows.setdefault(row[table.key], {}).update(row)
+                    return 201, [dict(table.rows[row[table.key]]) for row in rows] if representation else None
+
+                if self.command == "DELETE":
+                    rows = select_rows(table, params)
+                    for row in rows:
+                        del table.rows[row[table.key]]
+                    return 200, project(rows, params) if representation else None
+
+            return 405, {"message": "Method not allowed"}
+
+        def _dispatch(self):
+            try:
+                status, payload = self._handle()
+            except (KeyError, ValueError) as e:
+                status, payload = 400, {"message": str(e)}
+            self._reply(status, payload)
+
+        do_GET = do_POST = do_DELETE = do_PATCH = _dispatch
+
+    return Handler
+
+def serve(host="127.0.0.1", port=0, latency_ms=0.0, jitter_ms=0.0):
+    """Start the fake in a background thread. Returns (server, table); server.server_port has the port."""
+    table = Table()
+    server = ThreadingHTTPServer((host, port), make_handler(table, latency_ms / 1000, jitter_ms / 1000))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-postgrest", daemon=True).start()
+    return server, table
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay added to every request")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="random +/- spread around the delay")
+    args = parser.parse_args()
+
+    server, _ = serve(args.host, args.port, args.latency_ms, args.jitter_ms)
+    print(f"🧪 Fake PostgREST on http://{args.host}:{server.server_port} (latency {args.latency_ms}ms)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()